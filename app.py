@@ -1,7 +1,22 @@
 import os
 import io
+import array
+import asyncio
+import collections
+import glob
 import requests
 import json
+import hashlib
+import itertools
+import math
+import queue
+import re
+import shutil
+import stat
+import sys
+import threading
+import time
+import zipfile
 from flask import Flask, render_template, request, jsonify, Response, stream_with_context, send_file
 
 from flask_cors import CORS
@@ -14,15 +29,22 @@ from langchain_core.messages import HumanMessage, AIMessage
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 import uuid
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from markdown_render import MarkdownRenderer, render_markdown
+from imagess import OCR_COUNTERS, OcrSession, load_manifest, page_image_sizes
 try:
     import fitz  # PyMuPDF
+except Exception:
+    # Optional dependency; ingest falls back to pypdf text only
+    fitz = None
+try:
     import pytesseract
     from PIL import Image
 except Exception:
     # Optional dependencies; OCR will be skipped if not available
-    fitz = None
     pytesseract = None
     Image = None
 
@@ -33,6 +55,18 @@ CORS(app)
 
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
+# Overridable so the app can be pointed at a proxy or a local fake (see loadtest.py)
+DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")
+MISTRAL_API_URL = os.getenv("MISTRAL_API_URL")
+# Image OCR precomputed offline by `python imagess.py`; uploads with a matching
+# SHA-256 reuse it instead of running Tesseract
+OCR_MANIFEST_PATH = os.getenv("OCR_MANIFEST_PATH", "ocr_manifest.jsonl")
+
+STREAM_HEADERS = {
+    'Content-Type': 'text/plain; charset=utf-8',
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
 
 
 UPLOAD_FOLDER = 'uploads'
@@ -40,44 +74,459 @@ ALLOWED_EXTENSIONS = {'pdf'}
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Uploads are UUID-named and never rewritten, so browsers may cache them forever
+UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600
+# Build a deflated (and, where supported, linearized) copy of each upload for serving
+PDF_OPTIMIZE_ON_INGEST = os.getenv("PDF_OPTIMIZE_ON_INGEST", "0") == "1"
+OPTIMIZED_FOLDER = os.path.join(UPLOAD_FOLDER, 'optimized')
+
+# Ingest scheduling: lower numbers run first at every pipeline stage
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES", "500"))
+BULK_MAX_MEMBER_SIZE = 64 * 1024 * 1024  # per PDF inside an uploaded zip
+# Request body limits: the batch endpoint takes whole zips of manuals, everything else stays small
+UPLOAD_MAX_SIZE = 16 * 1024 * 1024
+BULK_MAX_REQUEST_SIZE = int(os.getenv("BULK_MAX_REQUEST_SIZE", str(1024 * 1024 * 1024)))
+INGEST_JOB_RETENTION = 3600  # seconds finished jobs stay visible in batch status
+
+CHROMA_DIR = "chroma_db"
+
+# Storage layout for new uploads:
+#   "per_document" - one Chroma collection (doc_<uuid>) per PDF (legacy layout)
+#   "shared"       - documents packed into one collection per tenant and
+#                    separated by a `document_id` metadata filter
+STORAGE_MODE = os.getenv("STORAGE_MODE", "per_document").lower()
+SHARED_COLLECTION_PREFIX = "docs_"
+DEFAULT_TENANT = "default"
+DOCUMENT_REGISTRY_PATH = os.path.join(CHROMA_DIR, "documents.json")
+CHROMA_BATCH_SIZE = 500
+
+# Storage maintenance (see collect_storage_garbage). The schedule runs every
+# STORAGE_GC_INTERVAL seconds (0 disables it); files and segment directories
+# younger than STORAGE_GC_GRACE seconds are never treated as orphans.
+STORAGE_GC_INTERVAL = int(os.getenv("STORAGE_GC_INTERVAL", str(24 * 3600)))
+STORAGE_GC_GRACE = int(os.getenv("STORAGE_GC_GRACE", "3600"))
+# Rebuild a shared collection once this fraction of its HNSW entries are deleted
+STORAGE_COMPACT_RATIO = float(os.getenv("STORAGE_COMPACT_RATIO", "0.2"))
+SQLITE_VACUUM_MIN_FREE_RATIO = float(os.getenv("SQLITE_VACUUM_MIN_FREE_RATIO", "0.1"))
+STORAGE_STATE_PATH = os.path.join(CHROMA_DIR, "maintenance.json")
+# Temporary names a shared collection passes through while being compacted
+COMPACT_SUFFIX = "__compact"
+RETIRED_SUFFIX = "__old"
+CHROMA_SQLITE_PATH = os.path.join(CHROMA_DIR, "chroma.sqlite3")
+
+# Embedding backend for new collections: "mistral" (API) or "local" (CPU, ONNX).
+# The backend and model are recorded in each collection's metadata so existing
+# collections keep being queried with the model that built them.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "mistral").lower()
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5")
+LOCAL_EMBEDDING_THREADS = int(os.getenv("LOCAL_EMBEDDING_THREADS", str(os.cpu_count() or 1)))
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "64"))
+# Collections created before backends were recorded were all built with Mistral
+LEGACY_EMBEDDING_BACKEND = ("mistral", "mistral-embed")
+
+class LocalEmbeddings(Embeddings):
+    """Sentence embeddings computed on the CPU with a quantized ONNX model (fastembed).
+
+    The model is downloaded/loaded on first use rather than at startup, and
+    inputs are embedded in batches across LOCAL_EMBEDDING_THREADS threads.
+    """
+
+    def __init__(self, model_name, batch_size=64, threads=None):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.threads = threads
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _get_model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    try:
+                        from fastembed import TextEmbedding
+                    except ImportError as e:
+                        raise RuntimeError("Local embeddings need the 'fastembed' package (pip install fastembed)") from e
+                    print(f"Loading local embedding model {self.model_name}")
+                    self._model = TextEmbedding(model_name=self.model_name, threads=self.threads)
+        return self._model
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        return [vector.tolist() for vector in self._get_model().embed(list(texts), batch_size=self.batch_size)]
+
+    def embed_query(self, text):
+        return next(iter(self._get_model().query_embed(text))).tolist()
+
+# backend name -> factory(model) returning a LangChain Embeddings instance
+EMBEDDING_BACKENDS = {
+    "mistral": lambda model: MistralAIEmbeddings(model=model or "mistral-embed", **({"endpoint": MISTRAL_API_URL} if MISTRAL_API_URL else {})),
+    "local": lambda model: LocalEmbeddings(model or LOCAL_EMBEDDING_MODEL, batch_size=LOCAL_EMBEDDING_BATCH_SIZE, threads=LOCAL_EMBEDDING_THREADS),
+}
+DEFAULT_EMBEDDING_MODELS = {"mistral": "mistral-embed", "local": LOCAL_EMBEDDING_MODEL}
 
+_embedding_instances = {}
+_embedding_lock = threading.Lock()
 
-embeddings = MistralAIEmbeddings(model="mistral-embed")
+def register_embedding_backend(name, factory, default_model=None):
+    """Make another embedding backend selectable via EMBEDDING_BACKEND / collection metadata"""
+    EMBEDDING_BACKENDS[name] = factory
+    DEFAULT_EMBEDDING_MODELS[name] = default_model
+
+def default_embedding_backend():
+    return (EMBEDDING_BACKEND, DEFAULT_EMBEDDING_MODELS.get(EMBEDDING_BACKEND))
+
+def get_embeddings(backend=None):
+    """Shared Embeddings instance for a (backend, model) pair, created on first use"""
+    backend = tuple(backend or default_embedding_backend())
+    if backend not in _embedding_instances:
+        with _embedding_lock:
+            if backend not in _embedding_instances:
+                name, model = backend
+                if name not in EMBEDDING_BACKENDS:
+                    raise ValueError(f"Unknown embedding backend: {name}")
+                _embedding_instances[backend] = EMBEDDING_BACKENDS[name](model)
+    return _embedding_instances[backend]
 
 retrievers = {}
 conversation_histories = {} 
 
+# doc_id -> {'collection', 'tenant', 'filename'} for documents stored in
+# shared collections; legacy doc_<uuid> collections are discovered by name.
+document_registry = {}
+registry_lock = threading.Lock()
+
+# doc_id -> owning tenant for every loaded document. Per-document collections
+# record it in their metadata; ones created before tenants existed belong to
+# DEFAULT_TENANT.
+document_tenants = {}
+
+# Serializes writes to shared collections with their compaction
+storage_lock = threading.RLock()
+
+# Vectors deleted from each shared collection since it was last compacted,
+# and the report of the last storage GC pass
+storage_state = {'deleted_vectors': {}, 'last_gc': None}
+
+_chroma_client = None
+
+def get_chroma_client():
+    """Return the process-wide persistent Chroma client"""
+    global _chroma_client
+    if _chroma_client is None:
+        import chromadb
+        _chroma_client = chromadb.PersistentClient(path=CHROMA_DIR)
+    return _chroma_client
+
+def load_document_registry():
+    """Read the shared-storage document registry from disk"""
+    if not os.path.isfile(DOCUMENT_REGISTRY_PATH):
+        return {}
+    try:
+        with open(DOCUMENT_REGISTRY_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error reading document registry: {e}")
+        return {}
+
+def save_document_registry():
+    """Atomically persist the shared-storage document registry"""
+    with registry_lock:
+        os.makedirs(CHROMA_DIR, exist_ok=True)
+        tmp_path = DOCUMENT_REGISTRY_PATH + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(document_registry, f, indent=2)
+        os.replace(tmp_path, DOCUMENT_REGISTRY_PATH)
+
+def load_storage_state():
+    if not os.path.isfile(STORAGE_STATE_PATH):
+        return
+    try:
+        with open(STORAGE_STATE_PATH, 'r', encoding='utf-8') as f:
+            storage_state.update(json.load(f))
+    except Exception as e:
+        print(f"Error reading storage state: {e}")
+
+def save_storage_state():
+    """Atomically persist deletion counters and the last GC report"""
+    with registry_lock:
+        os.makedirs(CHROMA_DIR, exist_ok=True)
+        tmp_path = STORAGE_STATE_PATH + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(storage_state, f, indent=2)
+        os.replace(tmp_path, STORAGE_STATE_PATH)
+
+def note_deleted_vectors(collection_name, count):
+    """Count deletions from a shared collection; HNSW keeps them as tombstones until compaction"""
+    deleted = storage_state['deleted_vectors']
+    deleted[collection_name] = deleted.get(collection_name, 0) + count
+    save_storage_state()
+
+def normalize_tenant(tenant):
+    """Reduce a tenant id to characters that are valid in a collection name"""
+    tenant = re.sub(r'[^A-Za-z0-9_-]', '', tenant or '')[:40]
+    return tenant or DEFAULT_TENANT
+
+def get_request_tenant():
+    """Tenant for the current request (X-Tenant-Id header or `tenant` field)"""
+    tenant = request.headers.get('X-Tenant-Id') or request.form.get('tenant') or request.args.get('tenant')
+    return normalize_tenant(tenant)
+
+def document_tenant(doc_id):
+    """Tenant that owns a document, including one that is still being ingested"""
+    tenant = document_tenants.get(doc_id)
+    if tenant is None:
+        job = ingest_scheduler.jobs.get(doc_id)
+        tenant = job['tenant'] if job else DEFAULT_TENANT
+    return tenant
+
+def document_visible(doc_id, tenant):
+    """True if the document is loaded and owned by `tenant`; other tenants get a 404"""
+    return doc_id in retrievers and document_tenant(doc_id) == normalize_tenant(tenant)
+
+def tenant_collection_name(tenant):
+    return f"{SHARED_COLLECTION_PREFIX}{normalize_tenant(tenant)}"
+
+def collection_embedding_backend(collection_name):
+    """(backend, model) recorded on an existing collection, or None if it doesn't exist"""
+    try:
+        metadata = get_chroma_client().get_collection(collection_name).metadata or {}
+    except Exception:
+        return None
+    if 'embedding_backend' not in metadata:
+        return LEGACY_EMBEDDING_BACKEND
+    return (metadata['embedding_backend'], metadata.get('embedding_model'))
+
+def target_embedding_backend(tenant=DEFAULT_TENANT):
+    """Backend that new chunks for a tenant must be embedded with.
+    Shared collections keep the model they were created with.
+    """
+    if STORAGE_MODE == "shared":
+        return collection_embedding_backend(tenant_collection_name(tenant)) or default_embedding_backend()
+    return default_embedding_backend()
+
+def get_vector_store(collection_name, embedding_backend=None, tenant=None):
+    """Open (or create) a collection paired with the embedding model that built it.
+    `tenant` is recorded on newly created per-document collections.
+    """
+    backend = embedding_backend or collection_embedding_backend(collection_name) or default_embedding_backend()
+    metadata = {'embedding_backend': backend[0], 'embedding_model': backend[1]}
+    if tenant:
+        metadata['tenant'] = tenant
+    return Chroma(
+        client=get_chroma_client(),
+        collection_name=collection_name,
+        embedding_function=get_embeddings(backend),
+        collection_metadata=metadata,
+    )
+
+def build_retriever(vector_store, document_id=None, k=5):
+    """Create a similarity retriever, filtered to one document in shared collections"""
+    search_kwargs = {"k": k}
+    if document_id is not None:
+        search_kwargs["filter"] = {"document_id": document_id}
+    return vector_store.as_retriever(search_type="similarity", search_kwargs=search_kwargs)
+
+def fallback_retriever(retriever, k):
+    """Retriever over the same vector store and document filter with a different k"""
+    document_filter = retriever.search_kwargs.get("filter")
+    search_kwargs = {"k": k}
+    if document_filter:
+        search_kwargs["filter"] = document_filter
+    return retriever.vectorstore.as_retriever(search_type="similarity", search_kwargs=search_kwargs)
+
+def add_chunks(vector_store, chunks, ids, vectors=None):
+    """Add chunks to a vector store, embedding them unless `vectors` are supplied"""
+    if vectors is None:
+        vector_store.add_documents(documents=chunks, ids=ids)
+        return
+    collection = vector_store._collection
+    for start in range(0, len(chunks), CHROMA_BATCH_SIZE):
+        end = start + CHROMA_BATCH_SIZE
+        collection.upsert(
+            ids=ids[start:end],
+            embeddings=vectors[start:end],
+            documents=[c.page_content for c in chunks[start:end]],
+            metadatas=[c.metadata for c in chunks[start:end]],
+        )
+
+def store_document_chunks(doc_id, chunks, tenant=DEFAULT_TENANT, filename=None, vectors=None, embedding_backend=None):
+    """Embed and store chunks for a document using the configured storage mode.
+    Pass `vectors` (and the `embedding_backend` that produced them) to store
+    pre-computed embeddings instead of calling the provider.
+    Returns the retriever for the document.
+    """
+    ids = [f"{doc_id}_{i}" for i in range(len(chunks))]
+    for chunk in chunks:
+        chunk.metadata['document_id'] = doc_id
+
+    if STORAGE_MODE == "shared":
+        collection_name = tenant_collection_name(tenant)
+        with storage_lock:
+            vector_store = get_vector_store(collection_name, embedding_backend)
+            add_chunks(vector_store, chunks, ids, vectors)
+            document_registry[doc_id] = {
+                'collection': collection_name,
+                'tenant': normalize_tenant(tenant),
+                'filename': filename,
+                'created_at': time.time(),
+            }
+            save_document_registry()
+        document_tenants[doc_id] = normalize_tenant(tenant)
+        print(f"Stored {len(chunks)} chunks in shared collection {collection_name}")
+        return build_retriever(vector_store, document_id=doc_id)
+
+    collection_name = f"doc_{doc_id}"
+    with storage_lock:
+        vector_store = get_vector_store(collection_name, embedding_backend, tenant=normalize_tenant(tenant))
+        add_chunks(vector_store, chunks, ids, vectors)
+    document_tenants[doc_id] = normalize_tenant(tenant)
+    print(f"Stored {len(chunks)} chunks in collection {collection_name}")
+    return build_retriever(vector_store)
+
+def delete_document_vectors(doc_id):
+    """Remove a document's vectors, by filter in shared collections or by dropping its own collection"""
+    client = get_chroma_client()
+    entry = document_registry.get(doc_id)
+    if entry:
+        with storage_lock:
+            collection = client.get_collection(entry['collection'])
+            count = len(collection.get(where={"document_id": doc_id}, include=[])["ids"])
+            collection.delete(where={"document_id": doc_id})
+            del document_registry[doc_id]
+            save_document_registry()
+        note_deleted_vectors(entry['collection'], count)
+        print(f"Deleted vectors for {doc_id} from shared collection {entry['collection']}")
+    else:
+        collection_name = f"doc_{doc_id}"
+        client.delete_collection(collection_name)
+        print(f"Deleted Chroma collection: {collection_name}")
+
+def migrate_to_shared_storage(tenant=DEFAULT_TENANT):
+    """Copy every legacy doc_<uuid> collection into the tenant's shared collection.
+    Stored embeddings are reused, so no embedding calls are made.
+    Returns the list of migrated document ids.
+    """
+    client = get_chroma_client()
+    collection_name = tenant_collection_name(tenant)
+    target_store = None
+    migrated = []
+
+    for collection in client.list_collections():
+        name = collection if isinstance(collection, str) else collection.name
+        if not name.startswith("doc_"):
+            continue
+        doc_id = name[4:]
+        if document_tenant(doc_id) != normalize_tenant(tenant):
+            continue
+        try:
+            backend = collection_embedding_backend(name)
+            if target_store is None:
+                # A new shared collection adopts the model of the first migrated document
+                target_backend = collection_embedding_backend(collection_name) or backend
+                target_store = get_vector_store(collection_name, target_backend)
+                target = target_store._collection
+            if backend != target_backend:
+                print(f"Skipping {name}: embedded with {backend}, {collection_name} uses {target_backend}")
+                continue
+            with storage_lock:
+                legacy = client.get_collection(name)
+                records = legacy.get(include=["documents", "metadatas", "embeddings"])
+                total = len(records["ids"])
+                for start in range(0, total, CHROMA_BATCH_SIZE):
+                    end = start + CHROMA_BATCH_SIZE
+                    metadatas = [dict(m or {}, document_id=doc_id) for m in records["metadatas"][start:end]]
+                    target.upsert(
+                        ids=[f"{doc_id}_{i}" for i in range(start, min(end, total))],
+                        embeddings=records["embeddings"][start:end],
+                        documents=records["documents"][start:end],
+                        metadatas=metadatas,
+                    )
+                document_registry[doc_id] = {
+                    'collection': collection_name,
+                    'tenant': normalize_tenant(tenant),
+                    'filename': None,
+                    'created_at': time.time(),
+                }
+                save_document_registry()
+                client.delete_collection(name)
+            retrievers[doc_id] = build_retriever(target_store, document_id=doc_id)
+            conversation_histories.setdefault(doc_id, ChatMessageHistory())
+            migrated.append(doc_id)
+            print(f"Migrated {total} chunks from {name} to {collection_name}")
+        except Exception as e:
+            print(f"Error migrating collection {name}: {e}")
+
+    return migrated
+
+def _collection_names(client):
+    return [c if isinstance(c, str) else c.name for c in client.list_collections()]
+
+def recover_interrupted_compactions():
+    """Finish or undo shared-collection compactions cut short by a crash.
+    Must run before any vector store is opened, since opening a missing
+    collection creates it empty. A non-empty base collection is kept as is;
+    otherwise the complete copy (__compact, else __old) takes the base name.
+    Leftover copies are only dropped once the base holds the data.
+    Returns the base names that were repaired.
+    """
+    client = get_chroma_client()
+    with storage_lock:
+        names = set(_collection_names(client))
+        bases = {n[:-len(suffix)] for n in names for suffix in (COMPACT_SUFFIX, RETIRED_SUFFIX) if n.endswith(suffix)}
+        repaired = []
+        for base in sorted(bases):
+            leftovers = [base + suffix for suffix in (COMPACT_SUFFIX, RETIRED_SUFFIX) if base + suffix in names]
+            if base in names and client.get_collection(base).count() > 0:
+                for leftover in leftovers:
+                    client.delete_collection(leftover)
+                continue
+            # The base is missing or empty; a __compact copy only survives a
+            # crash once it is complete, so it wins over __old
+            source = next((n for n in leftovers if client.get_collection(n).count() > 0), None)
+            if source is None:
+                continue
+            if base in names:
+                client.delete_collection(base)
+            client.get_collection(source).modify(name=base)
+            for leftover in leftovers:
+                if leftover != source:
+                    client.delete_collection(leftover)
+            repaired.append(base)
+            print(f"Recovered shared collection {base} from {source}")
+        return repaired
+
 def load_existing_retrievers():
     """Load existing retrievers from Chroma database on startup"""
     try:
-       
-        import chromadb
-        client = chromadb.PersistentClient(path="chroma_db")
+        client = get_chroma_client()
+        recover_interrupted_compactions()
         collections = client.list_collections()
         
         for collection in collections:
-            collection_name = collection.name
+            collection_name = collection if isinstance(collection, str) else collection.name
             if collection_name.startswith("doc_"):
                 doc_id = collection_name[4:]  
                 
-               
-                vector_store = Chroma(
-                    collection_name=collection_name,
-                    embedding_function=embeddings,
-                    persist_directory="chroma_db",
-                )
-                
-                retriever = vector_store.as_retriever(
-                    search_type="similarity",
-                    search_kwargs={
-                        "k": 5  
-                    }
-                )
-                
-                retrievers[doc_id] = retriever
+                vector_store = get_vector_store(collection_name)
+                document_tenants[doc_id] = (vector_store._collection.metadata or {}).get('tenant', DEFAULT_TENANT)
+                retrievers[doc_id] = build_retriever(vector_store)
                 conversation_histories[doc_id] = ChatMessageHistory()
                 
                 print(f"Loaded retriever for document: {doc_id}")
+
+        document_registry.update(load_document_registry())
+        load_storage_state()
+        shared_stores = {}
+        for doc_id, entry in document_registry.items():
+            collection_name = entry['collection']
+            if collection_name not in shared_stores:
+                shared_stores[collection_name] = get_vector_store(collection_name)
+            document_tenants[doc_id] = entry.get('tenant', DEFAULT_TENANT)
+            retrievers[doc_id] = build_retriever(shared_stores[collection_name], document_id=doc_id)
+            conversation_histories[doc_id] = ChatMessageHistory()
         
         print(f"Loaded {len(retrievers)} existing retrievers")
     except Exception as e:
@@ -86,262 +535,1682 @@ def load_existing_retrievers():
 
 load_existing_retrievers()
 
-def is_summarization_request(message):
-    """Check if the message is a summarization request"""
-    summarization_keywords = [
-        'summarize', 'summary', 'summarise', 'summaries',
-        'section', 'chapter', 'part', 'subsection',
-        'overview', 'brief', 'outline', 'key points'
-    ]
-    message_lower = message.lower()
-    return any(keyword in message_lower for keyword in summarization_keywords)
-
-def is_chapter_count_request(message):
-    """Check if the message is asking for chapter count or document structure"""
-    chapter_keywords = [
-        'how many chapters', 'total chapters', 'number of chapters',
-        'how many sections', 'total sections', 'number of sections',
-        'document structure', 'table of contents', 'chapters in this',
-        'sections in this', 'parts in this'
-    ]
-    message_lower = message.lower()
-    return any(keyword in message_lower for keyword in chapter_keywords)
-
-def is_opinion_request(message):
-    """Check if the message is asking for an opinion or analysis"""
-    opinion_keywords = [
-        'what do you think', 'your opinion', 'your thoughts',
-        'what is your view', 'do you agree', 'what is your take',
-        'analyze this', 'evaluate this', 'critique this',
-        'assess this', 'judge this', 'rate this'
-    ]
-    message_lower = message.lower()
-    return any(keyword in message_lower for keyword in opinion_keywords)
+# Intent rules in priority order: when several intents match, the earliest wins.
+# INTENT_RULES_PATH may point at a JSON list of rules in the same shape; a rule
+# whose intent already exists replaces the default, new intents are appended
+# (and answered with the regular question prompt).
+DEFAULT_INTENT_RULES = [
+    {
+        'intent': 'chapter_count',
+        'confidence': 0.9,
+        'patterns': [
+            r'how many (?:chapters|sections|parts)',
+            r'(?:total|number of) (?:chapters|sections|parts)',
+            r'document structure',
+            r'table of contents',
+            r'(?:chapters|sections|parts) in this',
+        ],
+    },
+    {
+        'intent': 'opinion',
+        'confidence': 0.9,
+        'patterns': [
+            r'what do you think',
+            r'your (?:opinion|thoughts|view|take)',
+            r'what is your (?:view|take)',
+            r'do you agree',
+            r'(?:analy[sz]e|evaluate|critique|assess|judge|rate) this',
+        ],
+    },
+    {
+        'intent': 'summarization',
+        'confidence': 0.85,
+        'patterns': [
+            r'\bsummar(?:y|ies|ize|ise|izing|ising)\b',
+            r'\boverview\b',
+            r'\boutline\b',
+            r'\bkey points\b',
+            # Only when aimed at the document itself: "briefly explain ohm's law"
+            # is an ordinary question
+            r'\bbrief(?:ly)? (?:me on|explain|describe|go over) (?:this|the(?: whole)?) (?:document|pdf|file|book|paper|report|chapter)\b',
+            r'\b(?:document|pdf|file|book|paper|report|chapter) in brief\b',
+        ],
+    },
+    {
+        # A bare reference such as "chapter 3" or "what's in section 2?"; a
+        # lookahead so the section number is still captured by the same scan
+        'intent': 'summarization',
+        'confidence': 0.6,
+        'patterns': [
+            r'^(?=\W*(?:what(?:\'s| is) in |tell me about |explain )?(?:the )?(?:sub)?(?:section|chapter|part)\s+\d+\W*$)',
+        ],
+    },
+]
+DEFAULT_INTENT = 'question'
+INTENT_MIN_CONFIDENCE = float(os.getenv("INTENT_MIN_CONFIDENCE", "0.5"))
+SECTION_REFERENCE_PATTERN = (
+    r'\b(?:sub)?(?:section|chapter|part)\s+(?P<section_a>\d+)\b'
+    r'|\b(?P<section_b>\d+)(?:st|nd|rd|th)?\s+(?:section|chapter)\b'
+)
 
-def extract_section_number(message):
-    """Extract section/chapter number from the message"""
-    import re
-    
-    patterns = [
-        r'section\s+(\d+)',
-        r'chapter\s+(\d+)',
-        r'part\s+(\d+)',
-        r'subsection\s+(\d+)',
-        r'(\d+)(?:st|nd|rd|th)?\s+section',
-        r'(\d+)(?:st|nd|rd|th)?\s+chapter'
-    ]
-    
+def intent_rule_error(rule):
+    """Why a custom intent rule can't be used, or None if it is valid"""
+    if not isinstance(rule, dict) or not isinstance(rule.get('intent'), str) or not rule['intent']:
+        return "a rule needs an 'intent' name"
+    patterns = rule.get('patterns')
+    if not isinstance(patterns, list) or not patterns or not all(isinstance(p, str) for p in patterns):
+        return "'patterns' must be a non-empty list of strings"
+    confidence = rule.get('confidence', 1.0)
+    if isinstance(confidence, bool) or not isinstance(confidence, (int, float)):
+        return "'confidence' must be a number"
     for pattern in patterns:
-        match = re.search(pattern, message.lower())
-        if match:
-            return int(match.group(1))
+        # Rules are combined into one regex, each pattern wrapped in a generated named group
+        try:
+            compiled = re.compile(f"(?P<rule>{pattern})")
+        except re.error as e:
+            return f"bad pattern {pattern!r}: {e}"
+        if len(compiled.groupindex) > 1:
+            return f"pattern {pattern!r} uses named groups"
     return None
 
+def load_intent_rules(path=None):
+    """Default intent rules merged with the optional JSON rules file.
+    Invalid custom rules are logged and skipped.
+    """
+    rules = [dict(rule) for rule in DEFAULT_INTENT_RULES]
+    path = path or os.getenv("INTENT_RULES_PATH")
+    if not path:
+        return rules
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            custom_rules = json.load(f)
+    except Exception as e:
+        print(f"Error reading intent rules from {path}: {e}")
+        return rules
+    if not isinstance(custom_rules, list):
+        print(f"Ignoring intent rules in {path}: expected a JSON list")
+        return rules
+    for custom in custom_rules:
+        error = intent_rule_error(custom)
+        if error:
+            print(f"Skipping intent rule {custom.get('intent') if isinstance(custom, dict) else custom!r} from {path}: {error}")
+            continue
+        replaced = [i for i, rule in enumerate(rules) if rule['intent'] == custom['intent']]
+        if replaced:
+            rules = [rule for rule in rules if rule['intent'] != custom['intent']]
+            rules.insert(replaced[0], custom)
+        else:
+            rules.append(custom)
+    return rules
+
+class IntentRouter:
+    """Classifies a chat message with one precompiled regex and a single scan.
+
+    Every rule pattern becomes a named alternative of one combined pattern,
+    together with the section-number reference, so a message is lowercased
+    and scanned once no matter how many rules are configured.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        alternatives = []
+        self._group_rule = {}
+        for rule_index, rule in enumerate(rules):
+            for pattern_index, pattern in enumerate(rule['patterns']):
+                group = f"rule{rule_index}_{pattern_index}"
+                self._group_rule[group] = rule_index
+                alternatives.append(f"(?P<{group}>{pattern})")
+        alternatives.append(f"(?P<section_ref>{SECTION_REFERENCE_PATTERN})")
+        self._pattern = re.compile("|".join(alternatives), re.MULTILINE)
+
+    def classify(self, message):
+        """Return {'intent', 'confidence', 'section_number'} for a message"""
+        section_number = None
+        matched = set()
+        for match in self._pattern.finditer((message or '').lower()):
+            group = match.lastgroup
+            if group == 'section_ref':
+                if section_number is None:
+                    section_number = int(match.group('section_a') or match.group('section_b'))
+            else:
+                matched.add(self._group_rule[group])
+
+        # Earliest rule wins; among rules for the same intent keep the best confidence
+        intent, confidence = DEFAULT_INTENT, 1.0
+        if matched:
+            best_index = min(matched)
+            intent = self.rules[best_index]['intent']
+            confidence = max(self.rules[i].get('confidence', 1.0) for i in matched if self.rules[i]['intent'] == intent)
+            if confidence < INTENT_MIN_CONFIDENCE:
+                intent, confidence = DEFAULT_INTENT, 1.0 - confidence
+        return {
+            'intent': intent,
+            'confidence': confidence,
+            'section_number': section_number,
+        }
+
+try:
+    intent_router = IntentRouter(load_intent_rules())
+except re.error as e:
+    print(f"Custom intent rules don't combine ({e}); using the defaults")
+    intent_router = IntentRouter(DEFAULT_INTENT_RULES)
+
+def classify_message(message):
+    """Classify a chat message and derive the prompt-mode flags the chat routes use"""
+    result = intent_router.classify(message)
+    is_summarization = result['intent'] == 'summarization'
+    return {
+        'intent': result['intent'],
+        'intent_confidence': result['confidence'],
+        'is_summarization': is_summarization,
+        'section_number': result['section_number'] if is_summarization else None,
+        'is_chapter_count': result['intent'] == 'chapter_count',
+        'is_opinion': result['intent'] == 'opinion',
+    }
+
 def format_response_text(text):
     """Convert markdown formatting to proper HTML and clean up text"""
-    import re
-    
     if not text:
         return text
+    return render_markdown(text)
+
+def _configure_tesseract():
+    """Configure pytesseract path from env on Windows if provided."""
+    if pytesseract is None:
+        return
+    cmd = os.getenv('TESSERACT_CMD')
+    if cmd and os.path.exists(cmd):
+        pytesseract.pytesseract.tesseract_cmd = cmd
+    else:
+        # Best-effort default path on Windows
+        default_win = r"C:\\Program Files\\Tesseract-OCR\\tesseract.exe"
+        if os.name == 'nt' and os.path.exists(default_win):
+            pytesseract.pytesseract.tesseract_cmd = default_win
+
+def iter_pdf_pages(doc):
+    """Walk an open PyMuPDF document once.
+    Yields one dict per page with its 0-based index, label, size, text blocks
+    as (x0, y0, x1, y1, text) in reading order, image xrefs for OCR and the
+    size in points each image is drawn at.
+    """
+    for page_index, page in enumerate(doc):
+        blocks = []
+        for block in page.get_text("blocks", sort=True):
+            # block_type 0 is text, 1 is an image placeholder
+            if block[6] == 0 and block[4].strip():
+                blocks.append((block[0], block[1], block[2], block[3], block[4]))
+        try:
+            xrefs = [img[0] for img in page.get_images(full=True)]
+        except Exception as e:
+            print(f"Failed to enumerate images on page {page_index+1}: {e}")
+            xrefs = []
+        image_sizes = page_image_sizes(page) if xrefs else {}
+        yield {
+            'index': page_index,
+            'label': page.get_label() or str(page_index + 1),
+            'width': page.rect.width,
+            'height': page.rect.height,
+            'blocks': blocks,
+            'images': xrefs,
+            'image_sizes': image_sizes,
+        }
+
+def ocr_image(doc, xref, session, display_size=None):
+    """OCR one embedded image by xref within the document's OcrSession; returns stripped text ('' if none)"""
+    base_image = doc.extract_image(xref)
+    return session.ocr(base_image.get("image") if base_image else None, display_size)
+
+# Image OCR outcomes since startup, summed over documents (see imagess.OcrSession)
+ocr_stats = dict.fromkeys(OCR_COUNTERS, 0)
+ocr_stats_lock = threading.Lock()
+
+def record_ocr_stats(counts):
+    with ocr_stats_lock:
+        for name, value in counts.items():
+            ocr_stats[name] = ocr_stats.get(name, 0) + value
+
+# Parsed OCR manifest, reloaded when the file changes
+ocr_manifest = {'mtime_ns': None, 'records': {}}
+ocr_manifest_lock = threading.Lock()
+
+def lookup_ocr_manifest(filepath):
+    """Return the offline OCR record for this PDF's contents, or None"""
+    try:
+        mtime_ns = os.stat(OCR_MANIFEST_PATH).st_mtime_ns
+    except OSError:
+        return None
+    with ocr_manifest_lock:
+        if ocr_manifest['mtime_ns'] != mtime_ns:
+            ocr_manifest['records'] = load_manifest(OCR_MANIFEST_PATH)
+            ocr_manifest['mtime_ns'] = mtime_ns
+        records = ocr_manifest['records']
+    record = records.get(file_content_hash(filepath))
+    if record and record.get('status') == 'done':
+        return record
+    return None
+
+def manifest_ocr_documents(filepath, record):
+    """Build the same OCR Documents extract_pdf_documents would, from a manifest record"""
+    return [
+        Document(
+            page_content=f"[Image OCR on page {image['page_label']}]\n{image['text']}",
+            metadata={
+                'source': filepath,
+                'page': image['page'],
+                'page_label': image['page_label'],
+                'type': 'image_ocr',
+                'image_index': image['image_index']
+            }
+        )
+        for image in record.get('images', [])
+        if image.get('text')
+    ]
+
+def extract_pdf_documents(filepath, ocr=True):
+    """Parse a PDF in a single PyMuPDF pass.
+    Returns (page_docs, ocr_docs): one Document per page of text and one per
+    image with OCR text. Both use the same 0-based `page` numbering.
+    """
+    manifest_record = lookup_ocr_manifest(filepath) if ocr else None
+    if manifest_record is not None:
+        print(f"Reusing offline OCR for {filepath} from {OCR_MANIFEST_PATH}")
+        ocr = False
+
+    if fitz is None:
+        print("PyMuPDF not installed; falling back to pypdf without image OCR")
+        loader = PyPDFLoader(filepath)
+        return loader.load(), manifest_ocr_documents(filepath, manifest_record) if manifest_record else []
+
+    ocr_enabled = ocr and pytesseract is not None and Image is not None
+    if ocr and not ocr_enabled:
+        print("OCR dependencies not installed; skipping image OCR")
+    if ocr_enabled:
+        _configure_tesseract()
+
+    doc = fitz.open(filepath)
+    page_docs = []
+    ocr_docs = []
+    # The same logo or banner is often embedded on every page under one xref
+    ocr_cache = {}
+    ocr_session = OcrSession()
+    try:
+        total_pages = doc.page_count
+        for page in iter_pdf_pages(doc):
+            page_index = page['index']
+            page_docs.append(
+                Document(
+                    page_content="\n".join(block[4].strip() for block in page['blocks']),
+                    metadata={
+                        'source': filepath,
+                        'page': page_index,
+                        'page_label': page['label'],
+                        'total_pages': total_pages,
+                    }
+                )
+            )
+            if not ocr_enabled:
+                continue
+            for img_index, xref in enumerate(page['images']):
+                try:
+                    if xref not in ocr_cache:
+                        ocr_cache[xref] = ocr_image(doc, xref, ocr_session, page['image_sizes'].get(xref))
+                    ocr_text = ocr_cache[xref]
+                    if not ocr_text:
+                        continue
+                    content = f"[Image OCR on page {page['label']}]\n{ocr_text}"
+                    ocr_docs.append(
+                        Document(
+                            page_content=content,
+                            metadata={
+                                'source': filepath,
+                                'page': page_index,
+                                'page_label': page['label'],
+                                'type': 'image_ocr',
+                                'image_index': img_index + 1
+                            }
+                        )
+                    )
+                except Exception as e:
+                    print(f"OCR failed on page {page_index+1} image {img_index+1}: {e}")
+                    continue
+    finally:
+        doc.close()
+
+    if manifest_record is not None:
+        ocr_docs = manifest_ocr_documents(filepath, manifest_record)
+    print(f"PDF loaded, {len(page_docs)} pages")
+    if ocr_enabled:
+        record_ocr_stats(ocr_session.counts)
+        counts = ocr_session.counts
+        print(f"OCR: {counts['processed']} processed, {counts['skipped_small'] + counts['skipped_low_entropy']} skipped, "
+              f"{counts['timed_out']} timed out, {counts['skipped_budget']} over budget")
+    if ocr_enabled or manifest_record is not None:
+        print(f"OCR produced {len(ocr_docs)} image-derived snippets")
+    return page_docs, ocr_docs
+
+def build_system_message(context, is_summarization=False, section_number=None, is_chapter_count=False, is_opinion=False):
+    """Pick the system prompt for the request mode and embed the retrieved context"""
+    if is_summarization and section_number:
+        return f"""You are an intelligent assistant that creates comprehensive summaries of specific sections from documents.
+Create a detailed summary of the requested section, organizing the information clearly and highlighting key points.
+Use bullet points, headings, and clear structure to make the summary easy to read.
+Focus only on the content from the specified section.
+
+Context from document (Section {section_number}):
+{context}"""
+    elif is_chapter_count:
+        return f"""You are an intelligent assistant that analyzes document structure and content.
+Analyze the provided context to determine the document's structure, including chapters, sections, and overall organization.
+Look for patterns like "Chapter X", "Section Y", numbered headings, or table of contents information.
+Provide a clear count of chapters/sections and describe the document's structure.
+
+Context from document:
+{context}"""
+    elif is_opinion:
+        return f"""You are an intelligent assistant with deep knowledge and analytical capabilities.
+Based on the provided context, give your thoughtful opinion and analysis. Be insightful, critical when appropriate, and provide valuable perspectives.
+Draw from your knowledge while staying grounded in the provided context. Be confident in your analysis but acknowledge limitations.
+Provide nuanced, intelligent commentary that adds value beyond just summarizing.
+
+Context from document:
+{context}"""
+    return f"""You are an intelligent assistant that provides comprehensive answers based on document context.
+Answer questions thoroughly using the provided context. Be insightful and analytical.
+If the context doesn't contain enough information, acknowledge this and provide what you can.
+Reference previous conversation context when relevant for better continuity.
+
+Context from document:
+{context}"""
+
+def build_deepseek_messages(message, context, conversation_history=None, is_summarization=False, section_number=None, is_chapter_count=False, is_opinion=False):
+    """Build the OpenAI-style message list: system prompt, prior turns, then the new question"""
+    system_message = build_system_message(context, is_summarization, section_number, is_chapter_count, is_opinion)
+    messages = [{"role": "system", "content": system_message}]
     
+    if conversation_history:
+        for msg in conversation_history:
+            if isinstance(msg, HumanMessage):
+                messages.append({"role": "user", "content": msg.content})
+            elif isinstance(msg, AIMessage):
+                messages.append({"role": "assistant", "content": msg.content})
     
-    text = re.sub(r'^# (.+)$', r'<h1>\1</h1>', text, flags=re.MULTILINE)
-    text = re.sub(r'^## (.+)$', r'<h2>\1</h2>', text, flags=re.MULTILINE)
-    text = re.sub(r'^### (.+)$', r'<h3>\1</h3>', text, flags=re.MULTILINE)
-    text = re.sub(r'^#### (.+)$', r'<h4>\1</h4>', text, flags=re.MULTILINE)
-    
-    text = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', text)
-    
-  
-    text = re.sub(r'\*(.*?)\*', r'<em>\1</em>', text)
+    messages.append({"role": "user", "content": message})
+    return messages
+
+def deepseek_headers():
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
+    }
+
+def parse_stream_line(line):
+    """Extract the content delta from one SSE line of a streaming completion.
+    Returns None for blank lines and the [DONE] marker (check `line` to tell them apart).
+    """
+    if not line:
+        return None
+    if line.startswith('data: '):
+        data_str = line[len('data: '):].strip()
+    else:
+        data_str = line.strip()
+    if data_str == '[DONE]':
+        return None
+    try:
+        obj = json.loads(data_str)
+        # OpenAI-style delta
+        delta = obj.get('choices', [{}])[0].get('delta', {})
+        return delta.get('content', '')
+    except Exception:
+        # If not JSON, pass raw text through
+        return data_str
+
+def is_stream_done(line):
+    return bool(line) and line.replace('data: ', '', 1).strip() == '[DONE]'
+
+def build_context(relevant_docs):
+    """Format retrieved chunks as numbered sources. Returns (context, sources)."""
+    context_parts = []
+    sources = []
+    for i, doc in enumerate(relevant_docs):
+        sources.append({
+            'index': i + 1,
+            'content': doc.page_content,
+            'page': doc.metadata.get('page', 'Unknown'),
+            'source': doc.metadata.get('source', 'Unknown')
+        })
+        context_parts.append(f"[Source {i+1}]\n{doc.page_content}")
+    return "\n\n".join(context_parts), sources
+
+def save_exchange(document_id, chat_history, message, formatted_response, response_meta):
+    """Append a question/answer pair (with sources and mode flags) to the document's history"""
+    ai_message = AIMessage(content=formatted_response)
+    ai_message.additional_kwargs = dict(response_meta)
+    chat_history.add_user_message(message)
+    chat_history.add_message(ai_message)
+    conversation_histories[document_id] = chat_history
+
+# Extra searches that help count a document's chapters and sections
+CHAPTER_COUNT_QUERIES = ["table of contents", "chapter", "section", "part", "introduction", "conclusion"]
+CHAT_FALLBACK_K = 5
+
+def chat_retrieval_queries(message, intent):
+    """Queries to retrieve chat context with, in order"""
+    if intent['is_chapter_count']:
+        return [message] + CHAPTER_COUNT_QUERIES
+    return [message]
+
+def merge_retrieved(results):
+    """Concatenate retrieval results, dropping chunks already seen"""
+    seen_content = set()
+    relevant_docs = []
+    for docs in results:
+        for doc in docs:
+            if doc.page_content not in seen_content:
+                seen_content.add(doc.page_content)
+                relevant_docs.append(doc)
+    return relevant_docs
+
+def retrieve_chat_docs(retriever, message, intent):
+    """Run the chat retrieval queries, falling back to a plain similarity search if nothing comes back.
+    asgi.py mirrors this with awaited searches.
+    """
+    relevant_docs = merge_retrieved(retriever.invoke(query) for query in chat_retrieval_queries(message, intent))
+    print(f"Initial retrieval found {len(relevant_docs)} documents")
+    if not relevant_docs:
+        print("Trying fallback retrieval with similarity search...")
+        relevant_docs = fallback_retriever(retriever, CHAT_FALLBACK_K).invoke(message)
+        print(f"Fallback retrieval found {len(relevant_docs)} documents")
+    return relevant_docs
+
+def build_chat_request(message, document_id, intent, relevant_docs, stream=False):
+    """Assemble the DeepSeek payload for a chat turn. Both servers build their
+    prompts here, so the same request sends the same prompt under Flask and ASGI.
+    The question is not in the history yet; save_exchange() adds it with the answer.
+    Returns (chat_history, payload, response_meta).
+    """
+    chat_history = conversation_histories.get(document_id, ChatMessageHistory())
+    is_summarization = intent['is_summarization']
+    context, sources = build_context(relevant_docs)
+    messages = build_deepseek_messages(message, context, chat_history.messages, is_summarization,
+                                       intent['section_number'], intent['is_chapter_count'], intent['is_opinion'])
+    payload = {
+        "model": "deepseek-chat",
+        "messages": messages,
+        "temperature": 0.1,
+        "max_tokens": 3000 if is_summarization and not stream else 2000
+    }
+    if stream:
+        payload["stream"] = True
+    response_meta = {
+        'sources': sources,
+        'is_summarization': is_summarization,
+        'section_number': intent['section_number'],
+        'is_chapter_count': intent['is_chapter_count'],
+        'is_opinion': intent['is_opinion'],
+        'intent': intent['intent']
+    }
+    return chat_history, payload, response_meta
+
+def call_deepseek_api(payload):
+    """Direct API call to DeepSeek with a payload from build_chat_request()"""
+    response = requests.post(DEEPSEEK_API_URL, headers=deepseek_headers(), json=payload)
+    if response.status_code == 200:
+        return response.json()["choices"][0]["message"]["content"]
+    else:
+        raise Exception(f"API call failed: {response.status_code} - {response.text}")
+
+class Overloaded(Exception):
+    """Raised when chat admission control rejects a request"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Flight:
+    """One in-flight chat computation shared by every identical request.
+
+    Published chunks are kept, so subscribers that join late replay the answer
+    from the start. Subscribers can be threads (Flask) or asyncio tasks (ASGI);
+    the producer can be either as well.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.result = None
+        self.error = None
+        self.started = False
+        self.done = False
+        self.subscribers = 1
+        self._cond = threading.Condition()
+        self._async_waiters = []  # (loop, asyncio.Event)
+
+    def _notify(self):
+        self._cond.notify_all()
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def start(self):
+        with self._cond:
+            self.started = True
+            self._notify()
+
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._notify()
+
+    def _complete(self, result=None, error=None):
+        with self._cond:
+            self.result = result
+            self.error = error
+            self.started = True
+            self.done = True
+            self._notify()
+
+    def wait_started(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.started, timeout)
+
+    def wait_done(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.done, timeout)
+
+    def iter_chunks(self):
+        """Yield every chunk (past and future) until the flight completes"""
+        index = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self.chunks) > index or self.done)
+                new_chunks = self.chunks[index:]
+                finished = self.done
+            index += len(new_chunks)
+            yield from new_chunks
+            if finished:
+                return
+
+    async def _await(self, predicate):
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self._cond:
+            self._async_waiters.append((loop, event))
+        try:
+            while True:
+                with self._cond:
+                    if predicate():
+                        return
+                    # Cleared under the lock, so a publish after this point sets it again
+                    event.clear()
+                await event.wait()
+        finally:
+            with self._cond:
+                self._async_waiters.remove((loop, event))
+
+    async def await_started(self):
+        await self._await(lambda: self.started)
+
+    async def await_done(self):
+        await self._await(lambda: self.done)
+
+    async def aiter_chunks(self):
+        index = 0
+        while True:
+            await self._await(lambda: len(self.chunks) > index or self.done)
+            with self._cond:
+                new_chunks = self.chunks[index:]
+                finished = self.done
+            index += len(new_chunks)
+            for chunk in new_chunks:
+                yield chunk
+            if finished:
+                return
+
+class SingleFlight:
+    """Registry of in-flight chat computations keyed by (document, question, mode)"""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """Return (flight, is_leader); the leader must run the computation"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.subscribers += 1
+                return flight, False
+            flight = Flight(key)
+            self._flights[key] = flight
+            return flight, True
+
+    def _forget(self, flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def finish(self, flight, result=None):
+        # Forget first so requests arriving after completion start a fresh computation
+        self._forget(flight)
+        if flight.subscribers > 1:
+            print(f"Coalesced {flight.subscribers} identical chat requests")
+        flight._complete(result=result)
+
+    def fail(self, flight, error):
+        self._forget(flight)
+        flight._complete(error=error)
+
+def coalesce_key(document_id, message, mode):
+    normalized = ' '.join(message.lower().split()).rstrip('?.! ')
+    return (document_id, normalized, mode)
+
+class AdmissionController:
+    """Caps concurrent upstream LLM calls globally and per document.
+
+    Requests over the caps wait in a bounded FIFO queue; when the queue is
+    full, or a request waits longer than `queue_timeout`, Overloaded is raised
+    with a Retry-After estimate based on recent call durations.
+    """
+
+    def __init__(self, global_limit, per_document_limit, queue_limit, queue_timeout):
+        self.global_limit = global_limit
+        self.per_document_limit = per_document_limit
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._active = 0
+        self._per_document = {}
+        self._waiters = collections.deque()
+        self._avg_duration = 10.0
+        self._rejected = 0
+
+    def _can_run(self, document_id):
+        return (self._active < self.global_limit
+                and self._per_document.get(document_id, 0) < self.per_document_limit)
+
+    def _grant(self, document_id):
+        self._active += 1
+        self._per_document[document_id] = self._per_document.get(document_id, 0) + 1
+
+    def retry_after(self):
+        estimate = self._avg_duration * (len(self._waiters) + 1) / self.global_limit
+        return max(1, min(60, math.ceil(estimate)))
+
+    def _enqueue_or_grant(self, document_id, wake):
+        """Grant immediately (returns None) or queue a waiter entry"""
+        with self._lock:
+            if self._can_run(document_id):
+                self._grant(document_id)
+                return None
+            if len(self._waiters) >= self.queue_limit:
+                self._rejected += 1
+                raise Overloaded('Too many concurrent chat requests, please retry shortly', self.retry_after())
+            entry = {'document_id': document_id, 'granted': False, 'wake': wake}
+            self._waiters.append(entry)
+            return entry
+
+    def _abandon(self, entry):
+        with self._lock:
+            if entry['granted']:
+                return
+            self._waiters.remove(entry)
+            self._rejected += 1
+            retry_after = self.retry_after()
+        raise Overloaded('Timed out waiting for chat capacity, please retry shortly', retry_after)
+
+    def acquire(self, document_id):
+        """Block until a slot is free (Flask threads)"""
+        granted = threading.Event()
+        entry = self._enqueue_or_grant(document_id, granted.set)
+        if entry is not None and not granted.wait(self.queue_timeout):
+            self._abandon(entry)
+
+    async def aacquire(self, document_id):
+        """Wait for a slot without blocking the event loop (ASGI)"""
+        loop = asyncio.get_running_loop()
+        granted = asyncio.Event()
+        entry = self._enqueue_or_grant(document_id, lambda: loop.call_soon_threadsafe(granted.set))
+        if entry is None:
+            return
+        try:
+            await asyncio.wait_for(granted.wait(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(entry)
+
+    def release(self, document_id, duration=None):
+        with self._lock:
+            self._active -= 1
+            remaining = self._per_document.get(document_id, 1) - 1
+            if remaining:
+                self._per_document[document_id] = remaining
+            else:
+                self._per_document.pop(document_id, None)
+            if duration is not None:
+                self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+            # Hand freed slots to the oldest waiters that fit under the caps
+            for entry in list(self._waiters):
+                if self._active >= self.global_limit:
+                    break
+                if self._can_run(entry['document_id']):
+                    self._waiters.remove(entry)
+                    self._grant(entry['document_id'])
+                    entry['granted'] = True
+                    entry['wake']()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': self._active,
+                'queued': len(self._waiters),
+                'rejected': self._rejected,
+                'avg_duration_seconds': round(self._avg_duration, 2),
+                'limits': {
+                    'max_concurrent': self.global_limit,
+                    'max_per_document': self.per_document_limit,
+                    'max_queue': self.queue_limit,
+                    'queue_timeout': self.queue_timeout,
+                },
+            }
+
+chat_flights = SingleFlight()
+chat_admission = AdmissionController(
+    global_limit=int(os.getenv("CHAT_MAX_CONCURRENT", "32")),
+    per_document_limit=int(os.getenv("CHAT_MAX_PER_DOCUMENT", "8")),
+    queue_limit=int(os.getenv("CHAT_MAX_QUEUE", "64")),
+    queue_timeout=float(os.getenv("CHAT_QUEUE_TIMEOUT", "30")),
+)
+
+def overloaded_response(error):
+    return jsonify({'error': str(error)}), 503, {'Retry-After': str(error.retry_after)}
+
+# path -> (mtime_ns, size, sha256 hex digest)
+file_hashes = {}
+
+def file_content_hash(path, stat_result=None):
+    """SHA-256 of a file, cached until its size or mtime changes"""
+    st = stat_result or os.stat(path)
+    cached = file_hashes.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    file_hashes[path] = (st.st_mtime_ns, st.st_size, digest.hexdigest())
+    return file_hashes[path][2]
+
+def optimize_pdf_copy(filepath):
+    """Write a garbage-collected, deflated copy of an upload for serving.
+    Linearizes it too when the installed PyMuPDF still supports that, so PDF.js
+    can show the first page before the rest arrives. The copy is kept only if
+    it is smaller than the original. Returns its path or None.
+    """
+    if fitz is None:
+        return None
+    os.makedirs(OPTIMIZED_FOLDER, exist_ok=True)
+    target = os.path.join(OPTIMIZED_FOLDER, os.path.basename(filepath))
+    tmp_path = target + '.tmp'
+    try:
+        doc = fitz.open(filepath)
+        try:
+            try:
+                doc.save(tmp_path, garbage=3, deflate=True, linear=True)
+            except Exception:
+                # Newer MuPDF releases dropped linearization support
+                doc.save(tmp_path, garbage=3, deflate=True)
+        finally:
+            doc.close()
+        if os.path.getsize(tmp_path) >= os.path.getsize(filepath):
+            os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, target)
+        file_content_hash(target)
+        print(f"Optimized copy written: {target}")
+        return target
+    except Exception as e:
+        print(f"Failed to optimize {filepath}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+
+def prepare_upload_for_serving(filepath):
+    """Hash a new upload for its ETag and optionally build the optimized copy.
+    Call this before the upload's name is returned to anyone: /uploads/<name>
+    is served as immutable, so the bytes behind it must never switch from the
+    original to the optimized copy.
+    """
+    file_content_hash(filepath)
+    if PDF_OPTIMIZE_ON_INGEST:
+        optimize_pdf_copy(filepath)
+
+def split_into_chunks(page_docs, ocr_docs=None):
+    """Split page Documents into retrieval chunks and append image OCR snippets"""
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000,
+        chunk_overlap=200,
+        add_start_index=True,
+    )
     
+    chunks = text_splitter.split_documents(page_docs)
+    print(f"PDF split into {len(chunks)} chunks") 
+    # Append OCR text extracted from images to the chunks so the retriever can answer about images
+    if ocr_docs:
+        chunks.extend(ocr_docs)
+        print(f"Appended {len(ocr_docs)} OCR chunks; total chunks now {len(chunks)}")
+    return chunks
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+class IngestScheduler:
+    """Shared, staged ingest pipeline for single and bulk uploads.
+
+    parse (PDF text + OCR + splitting) -> embed -> store, each stage with its
+    own worker pool. Jobs move between stages through priority queues, so an
+    interactive upload overtakes queued bulk work at every stage. The embed
+    stage packs chunks from several documents into one provider call and
+    slices large documents into batches, re-queueing the remainder so a
+    higher-priority job can get in between slices.
+    """
+
+    def __init__(self, parse_workers, embed_workers, store_workers, batch_size, batch_wait):
+        self.parse_workers = parse_workers
+        self.embed_workers = embed_workers
+        self.store_workers = store_workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.jobs = {}
+        self._parse_queue = queue.PriorityQueue()
+        self._embed_queue = queue.PriorityQueue()
+        self._store_queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._started = False
+        self._stats = {'documents': 0, 'failed': 0, 'pages': 0, 'chunks': 0, 'embed_calls': 0}
+        self._busy_since = None
+        self._busy_seconds = 0.0
+        self._active = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for target, count in ((self._parse_worker, self.parse_workers),
+                              (self._embed_worker, self.embed_workers),
+                              (self._store_worker, self.store_workers)):
+            for i in range(count):
+                threading.Thread(target=target, name=f"ingest-{target.__name__}-{i}", daemon=True).start()
+
+    def submit(self, filepath, doc_id, filename, tenant=DEFAULT_TENANT, priority=PRIORITY_BULK, batch_id=None,
+               prepare_serving=False):
+        """Queue a saved PDF for ingest and return its job dict.
+        With prepare_serving the parse stage first runs prepare_upload_for_serving();
+        /uploads/ holds the file back until it has.
+        """
+        self._ensure_started()
+        job = {
+            'id': doc_id,
+            'filepath': filepath,
+            'filename': filename,
+            'tenant': tenant,
+            'priority': priority,
+            'batch_id': batch_id,
+            'status': 'queued',
+            'serving_ready': not prepare_serving,
+            'error': None,
+            'pages': 0,
+            'chunks': 0,
+            'submitted_at': time.time(),
+            'finished_at': None,
+            'done': threading.Event(),
+            '_callbacks': [],
+        }
+        with self._lock:
+            self._prune_jobs()
+            self.jobs[doc_id] = job
+            if self._active == 0:
+                self._busy_since = time.monotonic()
+            self._active += 1
+        self._parse_queue.put((priority, next(self._seq), job))
+        return job
+
+    def add_done_callback(self, job, callback):
+        """Call `callback(job)` from a worker thread once the job finishes (or now if it has)"""
+        with self._lock:
+            if not job['done'].is_set():
+                job['_callbacks'].append(callback)
+                return
+        callback(job)
+
+    def _prune_jobs(self):
+        cutoff = time.time() - INGEST_JOB_RETENTION
+        for doc_id in [d for d, j in self.jobs.items() if j['finished_at'] and j['finished_at'] < cutoff]:
+            del self.jobs[doc_id]
+
+    def _finish(self, job, error=None):
+        with self._lock:
+            # Several embed workers can fail slices of the same job; only the first one finishes it
+            if job['done'].is_set():
+                return
+            job['finished_at'] = time.time()
+            if error:
+                job['status'] = 'failed'
+                job['error'] = error
+                self._stats['failed'] += 1
+            else:
+                job['status'] = 'done'
+                self._stats['documents'] += 1
+                self._stats['pages'] += job['pages']
+                self._stats['chunks'] += job['chunks']
+                # Another embed worker may still hold slices of a failed job,
+                # so only drop the payload once the job has been stored
+                job.pop('_chunks', None)
+                job.pop('_vectors', None)
+            self._active -= 1
+            if self._active == 0 and self._busy_since is not None:
+                self._busy_seconds += time.monotonic() - self._busy_since
+                self._busy_since = None
+            callbacks = job['_callbacks']
+            job['_callbacks'] = []
+            job['done'].set()
+        for callback in callbacks:
+            try:
+                callback(job)
+            except Exception as e:
+                print(f"Ingest callback failed for {job['id']}: {e}")
+
+    def _parse_worker(self):
+        while True:
+            priority, seq, job = self._parse_queue.get()
+            if not job['serving_ready']:
+                job['status'] = 'preparing'
+                try:
+                    prepare_upload_for_serving(job['filepath'])
+                except Exception as e:
+                    print(f"Error preparing {job['filepath']} for serving: {e}")
+                job['serving_ready'] = True
+            job['status'] = 'parsing'
+            try:
+                page_docs, ocr_docs = extract_pdf_documents(job['filepath'])
+            except Exception as e:
+                print(f"Error loading PDF: {e}")
+                self._finish(job, f'Failed to load PDF: {str(e)}')
+                continue
+            try:
+                chunks = split_into_chunks(page_docs, ocr_docs)
+            except Exception as e:
+                print(f"Error splitting PDF: {e}")
+                self._finish(job, f'Failed to process PDF: {str(e)}')
+                continue
+            if not chunks:
+                self._finish(job, 'Failed to process PDF: no text or OCR content found')
+                continue
+            try:
+                job['embedding_backend'] = target_embedding_backend(job['tenant'])
+            except Exception as e:
+                self._finish(job, f'Failed to create vector store: {str(e)}')
+                continue
+            job['pages'] = len(page_docs)
+            job['chunks'] = len(chunks)
+            job['_chunks'] = chunks
+            job['_vectors'] = [None] * len(chunks)
+            job['_embed_cursor'] = 0
+            job['_embedded'] = 0
+            job['status'] = 'embedding'
+            self._embed_queue.put((priority, seq, job))
+
+    def _take_embed_batch(self):
+        """Collect up to batch_size chunks across queued jobs, highest priority first"""
+        item = self._embed_queue.get()
+        slices = []
+        taken = 0
+        deadline = time.monotonic() + self.batch_wait
+        while True:
+            job = item[2]
+            if job['status'] == 'embedding':
+                start = job['_embed_cursor']
+                end = min(len(job['_chunks']), start + self.batch_size - taken)
+                job['_embed_cursor'] = end
+                slices.append((job, start, end))
+                taken += end - start
+                if end < len(job['_chunks']):
+                    # Put the remainder back so a higher-priority job can go next
+                    self._embed_queue.put(item)
+            if taken >= self.batch_size:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._embed_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+        return slices
+
+    def _embed_worker(self):
+        while True:
+            slices = self._take_embed_batch()
+            # A batch can mix documents bound for collections with different models
+            groups = {}
+            for job, start, end in slices:
+                groups.setdefault(job['embedding_backend'], []).append((job, start, end))
+            for backend, group in groups.items():
+                self._embed_group(backend, group)
+
+    def _embed_group(self, backend, slices):
+        texts = [chunk.page_content for job, start, end in slices for chunk in job['_chunks'][start:end]]
+        try:
+            vectors = get_embeddings(backend).embed_documents(texts)
+            with self._lock:
+                self._stats['embed_calls'] += 1
+        except Exception as e:
+            print(f"Error embedding batch of {len(texts)} chunks: {e}")
+            for job in {job['id']: job for job, _, _ in slices}.values():
+                self._finish(job, f'Failed to create vector store: {str(e)}')
+            return
+
+        offset = 0
+        for job, start, end in slices:
+            job_vectors = vectors[offset:offset + end - start]
+            # Advance past this slice even when its job has failed meanwhile,
+            # or every later document would get the wrong vectors
+            offset += end - start
+            with self._lock:
+                if job['status'] != 'embedding':
+                    continue
+                job['_vectors'][start:end] = job_vectors
+                job['_embedded'] += end - start
+                complete = job['_embedded'] == len(job['_chunks'])
+                if complete:
+                    job['status'] = 'storing'
+            if complete:
+                self._store_queue.put((job['priority'], next(self._seq), job))
+
+    def _store_worker(self):
+        while True:
+            priority, seq, job = self._store_queue.get()
+            try:
+                retriever = store_document_chunks(job['id'], job['_chunks'], job['tenant'], job['filename'], job['_vectors'], job['embedding_backend'])
+                retrievers[job['id']] = retriever
+                conversation_histories[job['id']] = ChatMessageHistory()
+            except Exception as e:
+                print(f"Error creating vector store: {e}")
+                self._finish(job, f'Failed to create vector store: {str(e)}')
+                continue
+            print(f"Ingested {job['filename']}: {job['pages']} pages, {job['chunks']} chunks")
+            self._finish(job)
+
+    def stats(self):
+        """Aggregate throughput over the time the pipeline has had work in flight"""
+        with self._lock:
+            busy = self._busy_seconds
+            if self._busy_since is not None:
+                busy += time.monotonic() - self._busy_since
+            stats = dict(self._stats)
+            stats['queued'] = self._active
+        stats['busy_seconds'] = round(busy, 3)
+        stats['pages_per_sec'] = round(stats['pages'] / busy, 2) if busy else 0.0
+        stats['chunks_per_sec'] = round(stats['chunks'] / busy, 2) if busy else 0.0
+        return stats
+
+def public_job(job):
+    """JSON-safe view of an ingest job"""
+    return {key: value for key, value in job.items() if not key.startswith('_') and key not in ('done', 'filepath')}
+
+def batch_summary(batch_id):
+    """Per-document status and throughput for one bulk upload"""
+    jobs = [job for job in ingest_scheduler.jobs.values() if job['batch_id'] == batch_id]
+    if not jobs:
+        return None
+    finished = [job for job in jobs if job['finished_at']]
+    started = min(job['submitted_at'] for job in jobs)
+    ended = max(job['finished_at'] for job in finished) if len(finished) == len(jobs) else time.time()
+    elapsed = max(ended - started, 1e-6)
+    pages = sum(job['pages'] for job in jobs if job['status'] == 'done')
+    chunks = sum(job['chunks'] for job in jobs if job['status'] == 'done')
+    return {
+        'batch_id': batch_id,
+        'total': len(jobs),
+        'done': sum(1 for job in jobs if job['status'] == 'done'),
+        'failed': sum(1 for job in jobs if job['status'] == 'failed'),
+        'complete': len(finished) == len(jobs),
+        'elapsed_seconds': round(elapsed, 3),
+        'pages_per_sec': round(pages / elapsed, 2),
+        'chunks_per_sec': round(chunks / elapsed, 2),
+        'documents': [public_job(job) for job in jobs],
+    }
+
+ingest_scheduler = IngestScheduler(
+    parse_workers=int(os.getenv("INGEST_PARSE_WORKERS", str(min(4, os.cpu_count() or 1)))),
+    embed_workers=int(os.getenv("INGEST_EMBED_WORKERS", "2")),
+    store_workers=int(os.getenv("INGEST_STORE_WORKERS", "1")),
+    batch_size=int(os.getenv("EMBED_BATCH_SIZE", "64")),
+    batch_wait=int(os.getenv("EMBED_BATCH_WAIT_MS", "50")) / 1000,
+)
+
+def save_upload_stream(stream, original_filename):
+    """Save an uploaded PDF under a fresh document id. Returns (doc_id, filename, filepath)."""
+    doc_id = str(uuid.uuid4())
+    filename = f"{doc_id}_{secure_filename(original_filename)}"
+    filepath = os.path.join(UPLOAD_FOLDER, filename)
+    with open(filepath, 'wb') as f:
+        shutil.copyfileobj(stream, f, 1024 * 1024)
+    return doc_id, filename, filepath
+
+# Storage maintenance: orphan cleanup, shared-collection compaction and SQLite vacuum.
+# Only one pass runs at a time; queries keep using the current collections
+# throughout and only shared-collection writes wait on storage_lock.
+storage_gc_lock = threading.Lock()
+UUID_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+UPLOAD_NAME_PATTERN = re.compile(r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})_')
+
+def path_size(path):
+    """Bytes used by a file or a directory tree"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def _older_than_grace(path):
+    try:
+        return time.time() - os.path.getmtime(path) > STORAGE_GC_GRACE
+    except OSError:
+        return False
+
+def _shared_document_ids(collection):
+    """Distinct document_id values stored in a shared collection, with their chunk counts"""
+    counts = collections.Counter()
+    total = collection.count()
+    for offset in range(0, total, CHROMA_BATCH_SIZE):
+        page = collection.get(include=["metadatas"], limit=CHROMA_BATCH_SIZE, offset=offset)
+        for metadata in page["metadatas"]:
+            counts[(metadata or {}).get('document_id')] += 1
+    return counts
+
+def _referenced_segment_ids():
+    """Segment ids Chroma's system database knows about, or None if it can't be read"""
+    if not os.path.isfile(CHROMA_SQLITE_PATH):
+        return None
+    import sqlite3
+    try:
+        conn = sqlite3.connect(f"file:{CHROMA_SQLITE_PATH}?mode=ro", uri=True, timeout=5)
+        try:
+            return {row[0] for row in conn.execute("SELECT id FROM segments")}
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"Could not read Chroma segments: {e}")
+        return None
+
+def compact_shared_collection(name):
+    """Rebuild a shared collection without the HNSW tombstones left by deletions.
+    Stored embeddings are copied into <name>__compact. Retrievers switch to
+    the copy, the original is renamed aside to <name>__old, the copy takes
+    the name and only then is the original dropped. At every step one
+    complete copy survives under a name recover_interrupted_compactions()
+    understands. Returns the number of chunks copied.
+    """
+    client = get_chroma_client()
+    temp_name = name + COMPACT_SUFFIX
+    with storage_lock:
+        old = client.get_collection(name)
+        backend = collection_embedding_backend(name)
+        try:
+            client.delete_collection(temp_name)
+        except Exception:
+            pass
+        new_store = get_vector_store(temp_name, backend)
+        target = new_store._collection
+        total = old.count()
+        for offset in range(0, total, CHROMA_BATCH_SIZE):
+            page = old.get(include=["documents", "metadatas", "embeddings"], limit=CHROMA_BATCH_SIZE, offset=offset)
+            target.upsert(ids=page["ids"], embeddings=page["embeddings"],
+                          documents=page["documents"], metadatas=page["metadatas"])
+        if target.count() != total:
+            client.delete_collection(temp_name)
+            raise RuntimeError(f"Compaction copy of {name} is incomplete")
+        for doc_id, entry in list(document_registry.items()):
+            if entry['collection'] == name and doc_id in retrievers:
+                retrievers[doc_id] = build_retriever(new_store, document_id=doc_id)
+        old.modify(name=name + RETIRED_SUFFIX)
+        target.modify(name=name)
+        client.delete_collection(name + RETIRED_SUFFIX)
+        storage_state['deleted_vectors'].pop(name, None)
+        save_storage_state()
+    print(f"Compacted {name}: {total} chunks")
+    return total
+
+def vacuum_chroma_sqlite(dry_run=False):
+    """VACUUM Chroma's SQLite file when enough of it is free pages. Returns bytes reclaimed."""
+    if not os.path.isfile(CHROMA_SQLITE_PATH):
+        return 0
+    import sqlite3
+    conn = sqlite3.connect(CHROMA_SQLITE_PATH, timeout=30)
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not page_count or free_pages / page_count < SQLITE_VACUUM_MIN_FREE_RATIO:
+            return 0
+        if dry_run:
+            return free_pages * page_size
+        before = path_size(CHROMA_SQLITE_PATH)
+        # Takes a short exclusive lock; a busy database just skips this round
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return max(before - path_size(CHROMA_SQLITE_PATH), 0)
+    except sqlite3.OperationalError as e:
+        print(f"Skipping SQLite vacuum: {e}")
+        return 0
+    finally:
+        conn.close()
+
+def _document_in_use(doc_id):
+    """True while a document is still being ingested or was registered within
+    STORAGE_GC_GRACE. Call under storage_lock so the answer holds until the
+    caller has finished deleting.
+    """
+    job = ingest_scheduler.jobs.get(doc_id)
+    if job and not job['finished_at']:
+        return True
+    entry = document_registry.get(doc_id)
+    return bool(entry) and time.time() - entry.get('created_at', 0) < STORAGE_GC_GRACE
+
+def collect_storage_garbage(dry_run=False):
+    """Reconcile uploads/, Chroma and the in-memory retrievers, then reclaim space.
+
+    Removes: uploads and optimized copies with no stored vectors, empty
+    doc_<uuid> collections, registry entries and retrievers whose vectors are
+    gone, shared-collection vectors of unregistered documents, and HNSW
+    segment directories Chroma no longer references. Then compacts shared
+    collections with many deleted vectors and vacuums the SQLite file.
+    Anything belonging to an in-flight ingest, or younger than
+    STORAGE_GC_GRACE, is left alone; ownership is checked again under
+    storage_lock right before each deletion, since ingests and imports keep
+    running during the pass. With dry_run nothing is changed.
+    Returns a report dict, or None if another pass is already running.
+    """
+    if not storage_gc_lock.acquire(blocking=False):
+        return None
+    try:
+        started = time.time()
+        storage_before = path_size(UPLOAD_FOLDER) + path_size(CHROMA_DIR)
+        client = get_chroma_client()
+        in_flight = {doc_id for doc_id, job in list(ingest_scheduler.jobs.items()) if not job['finished_at']}
+        removed = {'uploads': [], 'collections': [], 'registry_entries': [], 'retrievers': [],
+                   'shared_vectors': {}, 'segment_dirs': []}
+        reclaimable = collections.Counter()
+
+        # 1. Vector store: which documents actually have vectors
+        names = _collection_names(client)
+        if not dry_run:
+            recover_interrupted_compactions()
+            names = _collection_names(client)
+        names = [n for n in names if not n.endswith((COMPACT_SUFFIX, RETIRED_SUFFIX))]
+        stored = set()
+        for name in names:
+            if name.startswith("doc_"):
+                doc_id = name[4:]
+                if doc_id in in_flight:
+                    stored.add(doc_id)
+                    continue
+                with storage_lock:
+                    try:
+                        empty = client.get_collection(name).count() == 0
+                    except Exception as e:
+                        print(f"GC could not inspect {name}: {e}")
+                        empty = False
+                    if not empty or _document_in_use(doc_id):
+                        stored.add(doc_id)
+                        continue
+                    removed['collections'].append(name)
+                    if not dry_run:
+                        client.delete_collection(name)
+            elif name.startswith(SHARED_COLLECTION_PREFIX):
+                collection = client.get_collection(name)
+                chunk_counts = _shared_document_ids(collection)
+                for doc_id, count in chunk_counts.items():
+                    entry = document_registry.get(doc_id)
+                    if doc_id is None or doc_id in in_flight or (entry and entry['collection'] == name):
+                        stored.add(doc_id)
+                        continue
+                    with storage_lock:
+                        entry = document_registry.get(doc_id)
+                        if (entry and entry['collection'] == name) or _document_in_use(doc_id):
+                            stored.add(doc_id)
+                            continue
+                        removed['shared_vectors'][doc_id] = count
+                        if not dry_run:
+                            collection.delete(where={"document_id": doc_id})
+                    if not dry_run:
+                        note_deleted_vectors(name, count)
+
+        # 2. Registry entries and retrievers without vectors
+        for doc_id, entry in list(document_registry.items()):
+            if doc_id in stored or doc_id in in_flight:
+                continue
+            with storage_lock:
+                # Re-registered (or still ingesting) since step 1 looked
+                if document_registry.get(doc_id) is not entry or _document_in_use(doc_id):
+                    continue
+                removed['registry_entries'].append(doc_id)
+                if not dry_run:
+                    document_registry.pop(doc_id, None)
+        if removed['registry_entries'] and not dry_run:
+            with storage_lock:
+                save_document_registry()
+        for doc_id in list(retrievers):
+            if doc_id in stored or doc_id in in_flight:
+                continue
+            with storage_lock:
+                # Stored after step 1 scanned the collections
+                if (_document_in_use(doc_id) or f"doc_{doc_id}" in _collection_names(client)
+                        or (doc_id in document_registry and doc_id not in removed['registry_entries'])):
+                    continue
+                removed['retrievers'].append(doc_id)
+                if not dry_run:
+                    retrievers.pop(doc_id, None)
+                    conversation_histories.pop(doc_id, None)
+                    document_tenants.pop(doc_id, None)
+
+        # 3. Uploaded PDFs and optimized copies of documents that no longer exist
+        missing_files = set(stored)
+        for folder in (UPLOAD_FOLDER, OPTIMIZED_FOLDER):
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                if not os.path.isfile(path):
+                    continue
+                match = UPLOAD_NAME_PATTERN.match(name)
+                if match and folder == UPLOAD_FOLDER:
+                    missing_files.discard(match.group(1))
+                stray_tmp = folder == OPTIMIZED_FOLDER and name.endswith('.tmp')
+                orphan = match and match.group(1) not in stored and match.group(1) not in in_flight
+                if not (orphan or stray_tmp) or not _older_than_grace(path):
+                    continue
+                reclaimable['uploads'] += path_size(path)
+                removed['uploads'].append(path)
+                if not dry_run:
+                    os.remove(path)
+                    file_hashes.pop(path, None)
+
+        # 4. HNSW segment directories Chroma no longer references
+        referenced = _referenced_segment_ids()
+        if referenced is not None:
+            for name in os.listdir(CHROMA_DIR):
+                path = os.path.join(CHROMA_DIR, name)
+                if (os.path.isdir(path) and UUID_PATTERN.match(name)
+                        and name not in referenced and _older_than_grace(path)):
+                    reclaimable['segment_dirs'] += path_size(path)
+                    removed['segment_dirs'].append(name)
+                    if not dry_run:
+                        shutil.rmtree(path, ignore_errors=True)
+
+        # 5. Compaction and vacuum
+        compacted = []
+        for name in _collection_names(client):
+            if not name.startswith(SHARED_COLLECTION_PREFIX) or name.endswith((COMPACT_SUFFIX, RETIRED_SUFFIX)):
+                continue
+            deleted = storage_state['deleted_vectors'].get(name, 0)
+            live = client.get_collection(name).count()
+            if deleted and deleted / float(deleted + live) >= STORAGE_COMPACT_RATIO:
+                compacted.append(name)
+                if not dry_run:
+                    compact_shared_collection(name)
+        reclaimable['sqlite'] = vacuum_chroma_sqlite(dry_run)
+
+        report = {
+            'dry_run': dry_run,
+            'started_at': started,
+            'seconds': round(time.time() - started, 3),
+            'removed': removed,
+            'compacted': compacted,
+            'documents_missing_pdf': sorted(missing_files),
+            'bytes': dict(reclaimable),
+        }
+        if dry_run:
+            report['reclaimed_bytes'] = sum(reclaimable.values())
+        else:
+            report['reclaimed_bytes'] = max(storage_before - path_size(UPLOAD_FOLDER) - path_size(CHROMA_DIR), 0)
+            storage_state['last_gc'] = report
+            save_storage_state()
+        print(f"Storage GC{' (dry run)' if dry_run else ''}: {report['reclaimed_bytes']} bytes, "
+              f"{sum(len(v) for v in removed.values())} orphans, {len(compacted)} compacted")
+        return report
+    finally:
+        storage_gc_lock.release()
+
+def run_storage_gc_schedule():
+    while True:
+        time.sleep(STORAGE_GC_INTERVAL)
+        try:
+            collect_storage_garbage()
+        except Exception as e:
+            print(f"Scheduled storage GC failed: {e}")
+
+if STORAGE_GC_INTERVAL > 0:
+    threading.Thread(target=run_storage_gc_schedule, name="storage-gc", daemon=True).start()
+
+# Portable document bundles: a zip holding the PDF, its chunks with metadata and
+# their embeddings, so another node can load a processed document without
+# parsing, OCR or embedding calls.
+BUNDLE_FORMAT = "pdfchat-document-bundle"
+BUNDLE_VERSION = 1
+BUNDLE_MAX_MEMBER_SIZE = 512 * 1024 * 1024
+# A bundle holds the PDF plus its chunks and embeddings, so imports get their own body limit
+BUNDLE_MAX_REQUEST_SIZE = int(os.getenv("BUNDLE_MAX_REQUEST_SIZE", str(1024 * 1024 * 1024)))
+
+class BundleError(Exception):
+    """A bundle that can't be exported or imported; `status` is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def _chunk_index(chunk_id):
+    suffix = chunk_id.rsplit('_', 1)[-1]
+    return int(suffix) if suffix.isdigit() else -1
 
-    lines = text.split('\n')
-    formatted_lines = []
-    in_list = False
-    
-    for line in lines:
-        stripped = line.strip()
-        
-      
-        if stripped.startswith('- ') or stripped.startswith('* '):
-            if not in_list:
-                formatted_lines.append('<ul>')
-                in_list = True
-            item_text = stripped[2:].strip()
-            formatted_lines.append(f'<li>{item_text}</li>')
-        elif stripped.startswith(('1. ', '2. ', '3. ', '4. ', '5. ', '6. ', '7. ', '8. ', '9. ')):
-            if not in_list:
-                formatted_lines.append('<ol>')
-                in_list = True
-          
-            match = re.match(r'^(\d+)\.\s*(.+)$', stripped)
-            if match:
-                item_text = match.group(2).strip()
-                formatted_lines.append(f'<li>{item_text}</li>')
-        else:
-            if in_list:
-                formatted_lines.append('</ul>' if any(line.startswith(('1. ', '2. ', '3. ', '4. ', '5. ', '6. ', '7. ', '8. ', '9. ')) for line in lines[lines.index(line):lines.index(line)+3]) else '</ul>')
-                in_list = False
-            
-      
-            if stripped:
-                formatted_lines.append(f'<p>{line}</p>')
-            else:
-                formatted_lines.append('<br>')
-    
- 
-    if in_list:
-        formatted_lines.append('</ul>')
-    formatted_text = '\n'.join(formatted_lines)
-    
-    formatted_text = re.sub(r'(<br>\s*){3,}', '<br><br>', formatted_text)
-    
-    # Clean up empty paragraphs
-    formatted_text = re.sub(r'<p>\s*</p>', '', formatted_text)
-    
-    return formatted_text
+def document_records(doc_id):
+    """(records, embedding_backend) for a stored document, chunks in their original order"""
+    client = get_chroma_client()
+    entry = document_registry.get(doc_id)
+    collection_name = entry['collection'] if entry else f"doc_{doc_id}"
+    backend = collection_embedding_backend(collection_name)
+    if backend is None:
+        raise BundleError('Document not found', 404)
+    where = {"document_id": doc_id} if entry else None
+    records = client.get_collection(collection_name).get(
+        where=where, include=["documents", "metadatas", "embeddings"])
+    order = sorted(range(len(records["ids"])), key=lambda i: _chunk_index(records["ids"][i]))
+    return [(records["documents"][i], records["metadatas"][i] or {}, records["embeddings"][i]) for i in order], backend
 
-def _configure_tesseract():
-    """Configure pytesseract path from env on Windows if provided."""
-    if pytesseract is None:
-        return
-    cmd = os.getenv('TESSERACT_CMD')
-    if cmd and os.path.exists(cmd):
-        pytesseract.pytesseract.tesseract_cmd = cmd
-    else:
-        # Best-effort default path on Windows
-        default_win = r"C:\\Program Files\\Tesseract-OCR\\tesseract.exe"
-        if os.name == 'nt' and os.path.exists(default_win):
-            pytesseract.pytesseract.tesseract_cmd = default_win
+def document_upload_path(doc_id):
+    matches = sorted(glob.glob(os.path.join(UPLOAD_FOLDER, f"{glob.escape(doc_id)}_*")))
+    return matches[0] if matches else None
 
-def ocr_images_from_pdf(pdf_path):
-    """Extract text from images in a PDF using PyMuPDF + Tesseract.
-    Returns a list of LangChain Document objects with OCR text.
-    """
-    if fitz is None or pytesseract is None or Image is None:
-        print("OCR dependencies not installed; skipping image OCR")
-        return []
+def export_document_bundle(doc_id):
+    """Package a stored document as bundle bytes"""
+    records, backend = document_records(doc_id)
+    if not records:
+        raise BundleError('Document has no stored chunks', 404)
+    dimensions = len(records[0][2])
+    vectors = array.array('f')
+    chunk_lines = []
+    for text, metadata, embedding in records:
+        if len(embedding) != dimensions:
+            raise BundleError('Stored embeddings have inconsistent dimensions', 500)
+        vectors.fromlist(embedding.tolist() if hasattr(embedding, 'tolist') else list(embedding))
+        chunk_lines.append(json.dumps({'text': text, 'metadata': metadata}, ensure_ascii=False))
+    if sys.byteorder != 'little':
+        vectors.byteswap()
 
-    _configure_tesseract()
+    members = {
+        'chunks.jsonl': ("\n".join(chunk_lines) + "\n").encode('utf-8'),
+        'embeddings.f32': vectors.tobytes(),
+    }
+    pdf_path = document_upload_path(doc_id)
+    filename = None
+    if pdf_path:
+        with open(pdf_path, 'rb') as f:
+            members['document.pdf'] = f.read()
+        filename = os.path.basename(pdf_path)[len(doc_id) + 1:]
+
+    manifest = {
+        'format': BUNDLE_FORMAT,
+        'version': BUNDLE_VERSION,
+        'document_id': doc_id,
+        'filename': filename,
+        'created_at': time.time(),
+        'embedding_backend': list(backend),
+        'dimensions': dimensions,
+        'chunks': len(records),
+        'files': {name: hashlib.sha256(data).hexdigest() for name, data in members.items()},
+    }
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+        for name, data in members.items():
+            # PDFs are already compressed internally; deflating them again buys little
+            archive.writestr(name, data, compress_type=zipfile.ZIP_STORED if name.endswith('.pdf') else zipfile.ZIP_DEFLATED)
+    return buffer.getvalue()
+
+def _read_bundle_member(archive, name):
     try:
-        doc = fitz.open(pdf_path)
-    except Exception as e:
-        print(f"Failed to open PDF for OCR: {e}")
-        return []
+        info = archive.getinfo(name)
+    except KeyError:
+        return None
+    if info.file_size > BUNDLE_MAX_MEMBER_SIZE:
+        raise BundleError(f'{name} is too large')
+    return archive.read(info)
 
-    ocr_docs = []
-    for page_index, page in enumerate(doc):
+def collection_dimensions(collection_name):
+    """Length of the vectors stored in an existing collection, or None if it is missing or empty"""
+    try:
+        page = get_chroma_client().get_collection(collection_name).get(limit=1, include=["embeddings"])
+    except Exception:
+        return None
+    embeddings = page.get("embeddings")
+    if embeddings is None or len(embeddings) == 0:
+        return None
+    return len(embeddings[0])
+
+def import_document_bundle(stream, tenant=DEFAULT_TENANT):
+    """Verify a bundle and load it into the vector store under its original document id.
+    Stored embeddings are used as-is, so the embedding provider is not called.
+    Nothing is written until the bundle agrees with the target collection, and
+    the PDF is only written once its chunks are stored.
+    Returns a summary dict.
+    """
+    try:
+        archive = zipfile.ZipFile(stream)
+    except zipfile.BadZipFile:
+        raise BundleError('Not a bundle file')
+    with archive:
         try:
-            images = page.get_images(full=True)
-        except Exception as e:
-            print(f"Failed to enumerate images on page {page_index+1}: {e}")
-            continue
-        if not images:
-            continue
-        for img_index, img in enumerate(images):
-            try:
-                xref = img[0]
-                base_image = doc.extract_image(xref)
-                image_bytes = base_image.get("image")
-                if not image_bytes:
-                    continue
-                pil_img = Image.open(io.BytesIO(image_bytes))
-                ocr_text = pytesseract.image_to_string(pil_img) or ""
-                ocr_text = ocr_text.strip()
-                if not ocr_text:
-                    continue
-                content = f"[Image OCR on page {page_index+1}]\n{ocr_text}"
-                ocr_docs.append(
-                    Document(
-                        page_content=content,
-                        metadata={
-                            'page': page_index + 1,
-                            'source': pdf_path,
-                            'type': 'image_ocr',
-                            'image_index': img_index + 1
-                        }
-                    )
-                )
-            except Exception as e:
-                print(f"OCR failed on page {page_index+1} image {img_index+1}: {e}")
-                continue
-    print(f"OCR produced {len(ocr_docs)} image-derived snippets")
-    return ocr_docs
+            manifest = json.loads(_read_bundle_member(archive, 'manifest.json') or b'')
+        except ValueError:
+            raise BundleError('Bundle manifest is missing or unreadable')
+        if manifest.get('format') != BUNDLE_FORMAT:
+            raise BundleError('Not a document bundle')
+        if manifest.get('version') != BUNDLE_VERSION:
+            raise BundleError(f"Unsupported bundle version {manifest.get('version')}")
 
-def call_deepseek_api(message, context, conversation_history=None, is_summarization=False, section_number=None, is_chapter_count=False, is_opinion=False):
-    """Direct API call to DeepSeek with conversation history"""
-    url = "https://api.deepseek.com/v1/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
-    }
-    
-    
-    messages = []
-    
-    
-    if is_summarization and section_number:
-        system_message = f"""You are an intelligent assistant that creates comprehensive summaries of specific sections from documents.
-Create a detailed summary of the requested section, organizing the information clearly and highlighting key points.
-Use bullet points, headings, and clear structure to make the summary easy to read.
-Focus only on the content from the specified section.
+        members = {}
+        for name, expected in (manifest.get('files') or {}).items():
+            data = _read_bundle_member(archive, name)
+            if data is None:
+                raise BundleError(f'Bundle is missing {name}')
+            if hashlib.sha256(data).hexdigest() != expected:
+                raise BundleError(f'Checksum mismatch for {name}')
+            members[name] = data
+    if 'chunks.jsonl' not in members or 'embeddings.f32' not in members:
+        raise BundleError('Bundle has no chunks or embeddings')
 
-Context from document (Section {section_number}):
-{context}"""
-    elif is_chapter_count:
-        system_message = f"""You are an intelligent assistant that analyzes document structure and content.
-Analyze the provided context to determine the document's structure, including chapters, sections, and overall organization.
-Look for patterns like "Chapter X", "Section Y", numbered headings, or table of contents information.
-Provide a clear count of chapters/sections and describe the document's structure.
+    doc_id = manifest.get('document_id') or ''
+    if not UUID_PATTERN.match(doc_id):
+        raise BundleError('Bundle has an invalid document id')
+    if doc_id in retrievers or doc_id in document_registry:
+        raise BundleError('Document already exists', 409)
 
-Context from document:
-{context}"""
-    elif is_opinion:
-        system_message = f"""You are an intelligent assistant with deep knowledge and analytical capabilities.
-Based on the provided context, give your thoughtful opinion and analysis. Be insightful, critical when appropriate, and provide valuable perspectives.
-Draw from your knowledge while staying grounded in the provided context. Be confident in your analysis but acknowledge limitations.
-Provide nuanced, intelligent commentary that adds value beyond just summarizing.
+    backend = tuple(manifest.get('embedding_backend') or ())
+    if len(backend) != 2 or backend[0] not in EMBEDDING_BACKENDS:
+        raise BundleError(f'Unknown embedding backend {list(backend)}')
+    dimensions = manifest.get('dimensions')
+    if not isinstance(dimensions, int) or isinstance(dimensions, bool) or dimensions <= 0:
+        raise BundleError('Bundle has an invalid embedding dimension')
+    if STORAGE_MODE == "shared":
+        collection_name = tenant_collection_name(tenant)
+        existing = collection_embedding_backend(collection_name)
+        if existing is not None and existing != backend:
+            raise BundleError(f'Bundle was embedded with {list(backend)} but this tenant uses {list(existing)}', 409)
+        existing_dimensions = collection_dimensions(collection_name)
+        if existing_dimensions is not None and existing_dimensions != dimensions:
+            raise BundleError(f'Bundle vectors have {dimensions} dimensions but this tenant uses {existing_dimensions}', 409)
+    elif collection_embedding_backend(f"doc_{doc_id}") is not None:
+        raise BundleError('Document already exists', 409)
 
-Context from document:
-{context}"""
-    else:
-        system_message = f"""You are an intelligent assistant that provides comprehensive answers based on document context.
-Answer questions thoroughly using the provided context. Be insightful and analytical.
-If the context doesn't contain enough information, acknowledge this and provide what you can.
-Reference previous conversation context when relevant for better continuity.
+    try:
+        chunk_records = [json.loads(line) for line in members['chunks.jsonl'].decode('utf-8').splitlines() if line]
+    except ValueError:
+        raise BundleError('Bundle chunks are unreadable')
+    vectors = array.array('f')
+    vectors.frombytes(members['embeddings.f32'])
+    if sys.byteorder != 'little':
+        vectors.byteswap()
+    if not chunk_records or len(chunk_records) != manifest.get('chunks') or len(vectors) != len(chunk_records) * dimensions:
+        raise BundleError('Bundle chunks and embeddings do not match')
 
-Context from document:
-{context}"""
-    
-    messages.append({"role": "system", "content": system_message})
-    
-    
-    if conversation_history:
-        for msg in conversation_history:
-            if isinstance(msg, HumanMessage):
-                messages.append({"role": "user", "content": msg.content})
-            elif isinstance(msg, AIMessage):
-                messages.append({"role": "assistant", "content": msg.content})
-    
-   
-    messages.append({"role": "user", "content": message})
-    
-    data = {
-        "model": "deepseek-chat",
-        "messages": messages,
-        "temperature": 0.1,
-        "max_tokens": 3000 if is_summarization else 2000
+    filename = secure_filename(manifest.get('filename') or 'document.pdf')
+    server_filename = f"{doc_id}_{filename}"
+    filepath = os.path.join(UPLOAD_FOLDER, server_filename)
+
+    chunks = []
+    for record in chunk_records:
+        metadata = record.get('metadata') or {}
+        if 'source' in metadata:
+            metadata['source'] = filepath
+        chunks.append(Document(page_content=record.get('text') or '', metadata=metadata))
+    chunk_vectors = [vectors[i * dimensions:(i + 1) * dimensions].tolist() for i in range(len(chunks))]
+
+    retriever = store_document_chunks(doc_id, chunks, tenant, server_filename, chunk_vectors, backend)
+    if 'document.pdf' in members:
+        with open(filepath, 'wb') as f:
+            f.write(members['document.pdf'])
+        prepare_upload_for_serving(filepath)
+    retrievers[doc_id] = retriever
+    conversation_histories[doc_id] = ChatMessageHistory()
+    print(f"Imported bundle for {doc_id}: {len(chunks)} chunks, {backend[0]}/{backend[1]}")
+    return {
+        'id': doc_id,
+        'filename': filename,
+        'server_filename': server_filename,
+        'chunks': len(chunks),
+        'embedding_backend': list(backend),
     }
-    
-    response = requests.post(url, headers=headers, json=data)
-    if response.status_code == 200:
-        return response.json()["choices"][0]["message"]["content"]
-    else:
-        raise Exception(f"API call failed: {response.status_code} - {response.text}")
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# Body limits for endpoints that take more than UPLOAD_MAX_SIZE, keyed by endpoint name.
+# MAX_CONTENT_LENGTH is set to the largest of them so Werkzeug lets those bodies
+# through (and still caps bodies sent without a Content-Length); the per-endpoint
+# limit is checked below before the body is read.
+REQUEST_SIZE_LIMITS = {
+    'upload_batch': BULK_MAX_REQUEST_SIZE,
+    'import_bundles': BUNDLE_MAX_REQUEST_SIZE,
+}
+app.config['MAX_CONTENT_LENGTH'] = max([UPLOAD_MAX_SIZE, *REQUEST_SIZE_LIMITS.values()])
+
+@app.before_request
+def enforce_request_size_limit():
+    limit = REQUEST_SIZE_LIMITS.get(request.endpoint, UPLOAD_MAX_SIZE)
+    if request.content_length is not None and request.content_length > limit:
+        return jsonify({'error': f'Request too large (limit is {limit // (1024 * 1024)} MB)'}), 413
 
 @app.route('/')
 def index():
@@ -355,13 +2224,47 @@ def app_main():
 
 @app.route('/uploads/<path:filename>')
 def serve_uploaded_file(filename):
-    """Serve uploaded PDF files for PDF.js viewer."""
-    print(f"UPLOAD_FOLDER is: {UPLOAD_FOLDER}")
-    target_path = os.path.normpath(os.path.join(UPLOAD_FOLDER, filename))
-    print(f"Requested file: {filename}, resolved path: {target_path}, exists: {os.path.isfile(target_path)}")
-    if not os.path.isfile(target_path):
+    """Serve uploaded PDF files for PDF.js viewer.
+    send_file answers Range requests (PDF.js loads pages progressively) and
+    If-None-Match with 304 against the strong content-hash ETag.
+    """
+    match = UPLOAD_NAME_PATTERN.match(os.path.basename(filename))
+    if match and document_tenant(match.group(1)) != get_request_tenant():
         return jsonify({'error': 'File not found'}), 404
-    return send_file(target_path, mimetype='application/pdf')
+    job = ingest_scheduler.jobs.get(match.group(1)) if match else None
+    if job and not job['serving_ready']:
+        # Bulk uploads build their optimized copy in the background; serving the
+        # original now would change the bytes behind an immutable URL later
+        response = jsonify({'error': 'File is still being prepared'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    candidates = [safe_join(UPLOAD_FOLDER, filename)]
+    if PDF_OPTIMIZE_ON_INGEST:
+        candidates.insert(0, safe_join(OPTIMIZED_FOLDER, filename))
+    for path in candidates:
+        if path is None:
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        response = send_file(
+            path,
+            mimetype='application/pdf',
+            conditional=True,
+            etag=file_content_hash(path, st),
+            max_age=UPLOAD_CACHE_MAX_AGE,
+        )
+        response.headers['Cache-Control'] = f'public, max-age={UPLOAD_CACHE_MAX_AGE}, immutable'
+        response.headers['Accept-Ranges'] = 'bytes'
+        # Access depends on the tenant, which may come from this header
+        response.headers['Vary'] = 'X-Tenant-Id'
+        return response
+    return jsonify({'error': 'File not found'}), 404
 
 @app.route('/api/test', methods=['GET'])
 def test():
@@ -370,7 +2273,7 @@ def test():
 @app.route('/api/debug/<document_id>', methods=['GET'])
 def debug_document(document_id):
     """Debug endpoint to test document retrieval"""
-    if document_id not in retrievers:
+    if not document_visible(document_id, get_request_tenant()):
         return jsonify({'error': 'Document not found'}), 404
     
     retriever = retrievers[document_id]
@@ -419,72 +2322,22 @@ def upload_file():
                 print(f"Error saving file: {e}")  
                 return jsonify({'error': f'Failed to save file: {str(e)}'}), 500
             
-            try:
-                loader = PyPDFLoader(filepath)
-                docs = loader.load()
-                print(f"PDF loaded, {len(docs)} pages") 
-            except Exception as e:
-                print(f"Error loading PDF: {e}")  
-                return jsonify({'error': f'Failed to load PDF: {str(e)}'}), 500
-            
-            try:
-                text_splitter = RecursiveCharacterTextSplitter(
-                    chunk_size=1000,
-                    chunk_overlap=200,
-                    add_start_index=True,
-                )
-                
-                chunks = text_splitter.split_documents(docs)
-                print(f"PDF split into {len(chunks)} chunks") 
-                # Append OCR text extracted from images to the chunks so the retriever can answer about images
-                try:
-                    ocr_docs = ocr_images_from_pdf(filepath)
-                    if ocr_docs:
-                        chunks.extend(ocr_docs)
-                        print(f"Appended {len(ocr_docs)} OCR chunks; total chunks now {len(chunks)}")
-                except Exception as e:
-                    print(f"Skipping OCR due to error: {e}")
-            except Exception as e:
-                print(f"Error splitting PDF: {e}")  
-                return jsonify({'error': f'Failed to process PDF: {str(e)}'}), 500
+            # Interactive uploads share the ingest pipeline but jump ahead of bulk jobs
+            job = ingest_scheduler.submit(filepath, doc_id, filename, tenant=get_request_tenant(), priority=PRIORITY_INTERACTIVE)
+            # Overlaps with ingest; finishes before the filename is handed out
+            prepare_upload_for_serving(filepath)
+            job['done'].wait()
+            if job['status'] == 'failed':
+                print(f"Ingest failed for {original_filename}: {job['error']}")
+                return jsonify({'error': job['error']}), 500
             
-           
-            try:
-                collection_name = f"doc_{doc_id}"
-                vector_store = Chroma(
-                    collection_name=collection_name,
-                    embedding_function=embeddings,
-                    persist_directory="chroma_db",
-                )
-                print(f"Vector store created: {collection_name}") 
-                
-              
-                vector_store.add_documents(documents=chunks)
-                print("Documents added to vector store") 
-                
-                
-                retriever = vector_store.as_retriever(
-                    search_type="similarity",
-                    search_kwargs={
-                        "k": 5  
-                    }
-                )
-                
-                retrievers[doc_id] = retriever
-                
-               
-                conversation_histories[doc_id] = ChatMessageHistory()
-                
-                print(f"Upload successful for: {original_filename}")
-                return jsonify({
-                    'id': doc_id,
-                    'filename': original_filename,
-                    'server_filename': filename,
-                    'message': 'File uploaded and processed successfully'
-                })
-            except Exception as e:
-                print(f"Error creating vector store: {e}")  
-                return jsonify({'error': f'Failed to create vector store: {str(e)}'}), 500
+            print(f"Upload successful for: {original_filename}")
+            return jsonify({
+                'id': doc_id,
+                'filename': original_filename,
+                'server_filename': filename,
+                'message': 'File uploaded and processed successfully'
+            })
         
         return jsonify({'error': 'Invalid file type'}), 400
     
@@ -492,6 +2345,95 @@ def upload_file():
         print(f"Unexpected error in upload: {e}") 
         return jsonify({'error': f'Upload failed: {str(e)}'}), 500
 
+@app.route('/api/upload/batch', methods=['POST'])
+def upload_batch():
+    """Queue many PDFs (multipart `files`, zip archives allowed) for background ingest"""
+    uploads = request.files.getlist('files') or request.files.getlist('file')
+    if not uploads:
+        return jsonify({'error': 'No files provided'}), 400
+
+    batch_id = str(uuid.uuid4())
+    tenant = get_request_tenant()
+    documents = []
+    rejected = []
+
+    def queue_pdf(stream, original_filename):
+        if len(documents) >= BULK_MAX_FILES:
+            rejected.append({'filename': original_filename, 'error': f'Batch limit of {BULK_MAX_FILES} files reached'})
+            return
+        doc_id, filename, filepath = save_upload_stream(stream, original_filename)
+        # Hashing and the optimized copy happen in the parse stage, not in this request
+        ingest_scheduler.submit(filepath, doc_id, filename, tenant=tenant, priority=PRIORITY_BULK, batch_id=batch_id,
+                                prepare_serving=True)
+        documents.append({
+            'id': doc_id,
+            'filename': secure_filename(original_filename),
+            'server_filename': filename,
+            'status': 'queued'
+        })
+
+    for file in uploads:
+        name = file.filename or ''
+        try:
+            if name.lower().endswith('.zip'):
+                with zipfile.ZipFile(file.stream) as archive:
+                    for member in archive.infolist():
+                        member_name = os.path.basename(member.filename)
+                        if member.is_dir() or not allowed_file(member_name):
+                            continue
+                        if member.file_size > BULK_MAX_MEMBER_SIZE:
+                            rejected.append({'filename': member_name, 'error': 'File too large'})
+                            continue
+                        with archive.open(member) as stream:
+                            queue_pdf(stream, member_name)
+            elif allowed_file(name):
+                queue_pdf(file.stream, name)
+            else:
+                rejected.append({'filename': name, 'error': 'Invalid file type'})
+        except Exception as e:
+            print(f"Error queueing {name}: {e}")
+            rejected.append({'filename': name, 'error': str(e)})
+
+    if not documents:
+        return jsonify({'error': 'No PDF files found', 'rejected': rejected}), 400
+
+    print(f"Queued batch {batch_id} with {len(documents)} documents")
+    return jsonify({
+        'batch_id': batch_id,
+        'documents': documents,
+        'rejected': rejected,
+        'status_url': f'/api/upload/batch/{batch_id}'
+    }), 202
+
+@app.route('/api/upload/batch/<batch_id>', methods=['GET'])
+def get_upload_batch(batch_id):
+    """Progress and throughput for a bulk upload"""
+    summary = batch_summary(batch_id)
+    if summary is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(summary)
+
+@app.route('/api/ingest/stats', methods=['GET'])
+def get_ingest_stats():
+    """Aggregate ingest throughput (pages/sec, chunks/sec) and image OCR outcomes since startup"""
+    with ocr_stats_lock:
+        ocr = dict(ocr_stats)
+    return jsonify(dict(ingest_scheduler.stats(), ocr=ocr))
+
+def answer_chat(message, document_id):
+    """Retrieve context, call DeepSeek and record the exchange. Returns the response dict."""
+    intent = classify_message(message)
+    print(f"Performing retrieval for query: '{message}'")
+    relevant_docs = retrieve_chat_docs(retrievers[document_id], message, intent)
+    chat_history, payload, response_meta = build_chat_request(message, document_id, intent, relevant_docs)
+
+    response = call_deepseek_api(payload)
+
+    # Format the response text to convert markdown to HTML
+    formatted_response = format_response_text(response)
+    save_exchange(document_id, chat_history, message, formatted_response, response_meta)
+    return dict(response_meta, response=formatted_response)
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     print("Chat endpoint called")  
@@ -503,132 +2445,89 @@ def chat():
     if not message:
         return jsonify({'error': 'No message provided'}), 400
     
-    if document_id not in retrievers:
-        print(f"Document {document_id} not found in retrievers: {list(retrievers.keys())}")  # Debug print
+    if not document_visible(document_id, get_request_tenant()):
+        print(f"Document {document_id} not found for tenant {get_request_tenant()}")  # Debug print
         return jsonify({'error': 'Document not found'}), 404
     
-    try:
-        retriever = retrievers[document_id]
-        chat_history = conversation_histories.get(document_id, ChatMessageHistory())
-        is_summarization = is_summarization_request(message)
-        is_chapter_count = is_chapter_count_request(message)
-        is_opinion = is_opinion_request(message)
-        section_number = extract_section_number(message) if is_summarization else None
-        
-        
-        if is_chapter_count:
-            
-            search_queries = [
-                message,
-                "table of contents",
-                "chapter",
-                "section",
-                "part",
-                "introduction",
-                "conclusion"
-            ]
-            all_docs = []
-            for query in search_queries:
-                docs = retriever.invoke(query)
-                all_docs.extend(docs)
-
-            seen_content = set()
-            relevant_docs = []
-            for doc in all_docs:
-                if doc.page_content not in seen_content:
-                    seen_content.add(doc.page_content)
-                    relevant_docs.append(doc)
-        else:
-            # Regular retrieval
-            print(f"Performing regular retrieval for query: '{message}'")
-            relevant_docs = retriever.invoke(message)
-            print(f"Initial retrieval found {len(relevant_docs)} documents")
-        
-        # Fallback: if no documents retrieved, try with lower threshold
-        if not relevant_docs:
-            print("No relevant docs were retrieved using the relevance score threshold")
-            print("Trying fallback retrieval with similarity search...")
-            # Create a fallback retriever with regular similarity search
-            try:
-                # Access the vectorstore from the retriever
-                vectorstore = retriever.vectorstore
-                fallback_retriever = vectorstore.as_retriever(
-                    search_type="similarity",
-                    search_kwargs={"k": 5}  # Get more documents in fallback
-                )
-                relevant_docs = fallback_retriever.invoke(message)
-                print(f"Fallback retrieval found {len(relevant_docs)} documents")
-            except Exception as e:
-                print(f"Fallback retrieval failed: {e}")
-                # If fallback also fails, try to get any documents at all
-                try:
-                    print("Trying emergency fallback - getting any documents...")
-                    emergency_retriever = vectorstore.as_retriever(
-                        search_type="similarity",
-                        search_kwargs={"k": 10}  # Get even more documents
-                    )
-                    relevant_docs = emergency_retriever.invoke("document content")
-                    print(f"Emergency fallback found {len(relevant_docs)} documents")
-                except Exception as e2:
-                    print(f"Emergency fallback also failed: {e2}")
-                    relevant_docs = []
-        
-        # Format context from retrieved documents with metadata
-        context_parts = []
-        sources = []
-        
-        print(f"Processing {len(relevant_docs)} retrieved documents...")
-        
-        for i, doc in enumerate(relevant_docs):
-            source_info = {
-                'index': i + 1,
-                'content': doc.page_content,
-                'page': doc.metadata.get('page', 'Unknown'),
-                'source': doc.metadata.get('source', 'Unknown')
-            }
-            sources.append(source_info)
-            context_parts.append(f"[Source {i+1}]\n{doc.page_content}")
-            print(f"Added source {i+1}: {len(doc.page_content)} characters")
-        
-        context = "\n\n".join(context_parts)
-        print(f"Total context length: {len(context)} characters")
-        
-        # Add user message to history
-        chat_history.add_user_message(message)
-        
-        # Call DeepSeek API with conversation history
-        response = call_deepseek_api(message, context, chat_history.messages, is_summarization, section_number, is_chapter_count, is_opinion)
-        
-        # Format the response text to convert markdown to HTML
-        formatted_response = format_response_text(response)
-        
-        # Add AI response to history with metadata
-        ai_message = AIMessage(content=formatted_response)
-        # Store additional metadata as a custom attribute
-        ai_message.additional_kwargs = {
-            'sources': sources,
-            'is_summarization': is_summarization,
-            'section_number': section_number,
-            'is_chapter_count': is_chapter_count,
-            'is_opinion': is_opinion
-        }
-        chat_history.add_message(ai_message)
-        
-        # Update conversation history
-        conversation_histories[document_id] = chat_history
-        
-        return jsonify({
-            'response': formatted_response,
-            'sources': sources,
-            'is_summarization': is_summarization,
-            'section_number': section_number,
-            'is_chapter_count': is_chapter_count,
-            'is_opinion': is_opinion
-        })
+    # Identical questions already in flight share one retrieval + completion
+    flight, is_leader = chat_flights.join(coalesce_key(document_id, message, 'full'))
+    if is_leader:
+        try:
+            chat_admission.acquire(document_id)
+        except Overloaded as e:
+            chat_flights.fail(flight, e)
+            return overloaded_response(e)
+        started = time.monotonic()
+        try:
+            chat_flights.finish(flight, answer_chat(message, document_id))
+        except Exception as e:
+            chat_flights.fail(flight, e)
+        finally:
+            chat_admission.release(document_id, time.monotonic() - started)
+    else:
+        flight.wait_done()
     
+    if isinstance(flight.error, Overloaded):
+        return overloaded_response(flight.error)
+    if flight.error is not None:
+        print(f"Error: {flight.error}")
+        return jsonify({'error': f'An error occurred: {str(flight.error)}'}), 500
+    return jsonify(flight.result)
+
+def prepare_stream_chat(message, document_id):
+    """Classify, retrieve and build the streaming DeepSeek payload.
+    Returns (chat_history, payload, response_meta).
+    """
+    intent = classify_message(message)
+    relevant_docs = retrieve_chat_docs(retrievers[document_id], message, intent)
+    return build_chat_request(message, document_id, intent, relevant_docs, stream=True)
+
+def stream_chat_chunks(message, document_id, chat_history, payload, response_meta):
+    """Yield DeepSeek tokens, then save the exchange and yield the sources marker"""
+    # Render HTML for the history as tokens arrive instead of re-parsing the full answer
+    renderer = MarkdownRenderer()
+    rendered = []
+    try:
+        with requests.post(DEEPSEEK_API_URL, headers=deepseek_headers(), json=payload, stream=True) as r:
+            r.raise_for_status()
+            for line in r.iter_lines(decode_unicode=True):
+                if is_stream_done(line):
+                    break
+                content = parse_stream_line(line)
+                if content:
+                    rendered.append(renderer.feed(content))
+                    yield content
+    except Exception as e:
+        yield f"\n[Stream error: {str(e)}]"
+
+    # After stream completes: save to history and emit sources marker
+    try:
+        rendered.append(renderer.close())
+        save_exchange(document_id, chat_history, message, ''.join(rendered), response_meta)
+    except Exception:
+        pass
+
+    yield "\n[[SOURCES]]" + json.dumps(response_meta)
+
+def run_stream_flight(flight, message, document_id):
+    """Producer thread for a streaming flight; holds the admission slot until the stream ends.
+    Runs independently of any one client, so a leader disconnecting doesn't cut off the others.
+    """
+    started = time.monotonic()
+    try:
+        try:
+            chat_history, payload, response_meta = prepare_stream_chat(message, document_id)
+        except Exception as e:
+            chat_flights.fail(flight, e)
+            return
+        flight.start()
+        for chunk in stream_chat_chunks(message, document_id, chat_history, payload, response_meta):
+            flight.publish(chunk)
+        chat_flights.finish(flight)
     except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+        chat_flights.fail(flight, e)
+    finally:
+        chat_admission.release(document_id, time.monotonic() - started)
 
 @app.route('/api/chat/stream', methods=['POST'])
 def chat_stream():
@@ -639,160 +2538,36 @@ def chat_stream():
 
     if not message:
         return jsonify({'error': 'No message provided'}), 400
-    if document_id not in retrievers:
+    if not document_visible(document_id, get_request_tenant()):
         return jsonify({'error': 'Document not found'}), 404
 
-    try:
-        retriever = retrievers[document_id]
-        chat_history = conversation_histories.get(document_id, ChatMessageHistory())
-
-        is_summarization = is_summarization_request(message)
-        is_chapter_count = is_chapter_count_request(message)
-        is_opinion = is_opinion_request(message)
-        section_number = extract_section_number(message) if is_summarization else None
-
-        # Retrieval
-        relevant_docs = retriever.invoke(message)
-        if not relevant_docs:
-            vectorstore = retriever.vectorstore
-            fallback = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 5})
-            relevant_docs = fallback.invoke(message)
-
-        context_parts = []
-        sources = []
-        for i, doc in enumerate(relevant_docs):
-            sources.append({
-                'index': i + 1,
-                'content': doc.page_content,
-                'page': doc.metadata.get('page', 'Unknown'),
-                'source': doc.metadata.get('source', 'Unknown')
-            })
-            context_parts.append(f"[Source {i+1}]\n{doc.page_content}")
-        context = "\n\n".join(context_parts)
-
-        # Build DeepSeek payload with streaming
-        url = "https://api.deepseek.com/v1/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
-        }
-
-        # Build messages like call_deepseek_api
-        system_message = f"""You are an intelligent assistant that provides comprehensive answers based on document context.
-Answer questions thoroughly using the provided context. Be insightful and analytical.
-If the context doesn't contain enough information, acknowledge this and provide what you can.
-Reference previous conversation context when relevant for better continuity.
-
-Context from document:
-{context}"""
-        if is_summarization and section_number:
-            system_message = f"""You are an intelligent assistant that creates comprehensive summaries of specific sections from documents.
-Create a detailed summary of the requested section, organizing the information clearly and highlighting key points.
-Use bullet points, headings, and clear structure to make the summary easy to read.
-Focus only on the content from the specified section.
-
-Context from document (Section {section_number}):
-{context}"""
-        elif is_chapter_count:
-            system_message = f"""You are an intelligent assistant that analyzes document structure and content.
-Analyze the provided context to determine the document's structure, including chapters, sections, and overall organization.
-Look for patterns like "Chapter X", "Section Y", numbered headings, or table of contents information.
-Provide a clear count of chapters/sections and describe the document's structure.
-
-Context from document:
-{context}"""
-        elif is_opinion:
-            system_message = f"""You are an intelligent assistant with deep knowledge and analytical capabilities.
-Based on the provided context, give your thoughtful opinion and analysis. Be insightful, critical when appropriate, and provide valuable perspectives.
-Draw from your knowledge while staying grounded in the provided context. Be confident in your analysis but acknowledge limitations.
-Provide nuanced, intelligent commentary that adds value beyond just summarizing.
-
-Context from document:
-{context}"""
-
-        messages = [{"role": "system", "content": system_message}]
-        for msg in chat_history.messages:
-            if isinstance(msg, HumanMessage):
-                messages.append({"role": "user", "content": msg.content})
-            elif isinstance(msg, AIMessage):
-                messages.append({"role": "assistant", "content": msg.content})
-        messages.append({"role": "user", "content": message})
-
-        payload = {
-            "model": "deepseek-chat",
-            "messages": messages,
-            "temperature": 0.1,
-            "max_tokens": 2000,
-            "stream": True,
-        }
-
-        def generate():
-            buffer = []
-            try:
-                with requests.post(url, headers=headers, json=payload, stream=True) as r:
-                    r.raise_for_status()
-                    for line in r.iter_lines(decode_unicode=True):
-                        if not line:
-                            continue
-                        if line.startswith('data: '):
-                            data_str = line[len('data: '):].strip()
-                        else:
-                            data_str = line.strip()
-                        if data_str == '[DONE]':
-                            break
-                        try:
-                            obj = json.loads(data_str)
-                            # OpenAI-style delta
-                            delta = obj.get('choices', [{}])[0].get('delta', {})
-                            content = delta.get('content', '')
-                            if content:
-                                buffer.append(content)
-                                yield content
-                        except Exception:
-                            # If not JSON, yield raw text
-                            buffer.append(data_str)
-                            yield data_str
-            except Exception as e:
-                yield f"\n[Stream error: {str(e)}]"
-
-            # After stream completes: save to history and emit sources marker
-            full_text = ''.join(buffer)
-            try:
-                formatted = format_response_text(full_text)
-                ai_message = AIMessage(content=formatted)
-                ai_message.additional_kwargs = {
-                    'sources': sources,
-                    'is_summarization': is_summarization,
-                    'section_number': section_number,
-                    'is_chapter_count': is_chapter_count,
-                    'is_opinion': is_opinion
-                }
-                chat_history.add_user_message(message)
-                chat_history.add_message(ai_message)
-                conversation_histories[document_id] = chat_history
-            except Exception:
-                pass
+    flight, is_leader = chat_flights.join(coalesce_key(document_id, message, 'stream'))
+    if is_leader:
+        try:
+            chat_admission.acquire(document_id)
+        except Overloaded as e:
+            chat_flights.fail(flight, e)
+            return overloaded_response(e)
+        threading.Thread(target=run_stream_flight, args=(flight, message, document_id), daemon=True).start()
 
-            yield "\n[[SOURCES]]" + json.dumps({
-                'sources': sources,
-                'is_summarization': is_summarization,
-                'section_number': section_number,
-                'is_chapter_count': is_chapter_count,
-                'is_opinion': is_opinion
-            })
+    # Retrieval errors surface as a normal error response before any streaming starts
+    flight.wait_started()
+    if isinstance(flight.error, Overloaded):
+        return overloaded_response(flight.error)
+    if flight.error is not None and not flight.chunks:
+        return jsonify({'error': str(flight.error)}), 500
+    return Response(stream_with_context(flight.iter_chunks()), headers=STREAM_HEADERS)
 
-        headers_out = {
-            'Content-Type': 'text/plain; charset=utf-8',
-            'Cache-Control': 'no-cache',
-            'X-Accel-Buffering': 'no',
-        }
-        return Response(stream_with_context(generate()), headers=headers_out)
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+@app.route('/api/chat/admission', methods=['GET'])
+def get_chat_admission():
+    """Current chat concurrency, queue depth and rejection count"""
+    return jsonify(chat_admission.stats())
 
 @app.route('/api/chat/history/<document_id>', methods=['GET'])
 def get_chat_history(document_id):
     """Get chat history for a specific document"""
+    if document_id in conversation_histories and document_tenant(document_id) != get_request_tenant():
+        return jsonify({'error': 'Document not found'}), 404
     if document_id not in conversation_histories:
         return jsonify({'messages': []})
     
@@ -825,45 +2600,79 @@ def get_chat_history(document_id):
 @app.route('/api/chat/history/<document_id>', methods=['DELETE'])
 def clear_chat_history(document_id):
     """Clear chat history for a specific document"""
-    if document_id in conversation_histories:
+    if document_id in conversation_histories and document_tenant(document_id) == get_request_tenant():
         conversation_histories[document_id] = ChatMessageHistory()
         return jsonify({'message': 'Chat history cleared'})
     
     return jsonify({'error': 'Document not found'}), 404
 
+@app.route('/api/documents/<document_id>/bundle', methods=['GET'])
+def export_bundle(document_id):
+    """Download a processed document as a portable bundle"""
+    if not document_visible(document_id, get_request_tenant()):
+        return jsonify({'error': 'Document not found'}), 404
+    try:
+        data = export_document_bundle(document_id)
+    except BundleError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        print(f"Error exporting bundle for {document_id}: {e}")
+        return jsonify({'error': f'Export failed: {str(e)}'}), 500
+    return send_file(io.BytesIO(data), mimetype='application/zip', as_attachment=True,
+                     download_name=f"{document_id}.pdfbundle")
+
+@app.route('/api/documents/import', methods=['POST'])
+def import_bundles():
+    """Load one or more bundles (multipart `file`/`files`) exported by another node"""
+    uploads = request.files.getlist('files') or request.files.getlist('file')
+    if not uploads:
+        return jsonify({'error': 'No bundle provided'}), 400
+    tenant = get_request_tenant()
+    imported = []
+    rejected = []
+    for file in uploads:
+        try:
+            imported.append(import_document_bundle(file.stream, tenant))
+        except BundleError as e:
+            rejected.append({'filename': file.filename, 'error': str(e), 'status': e.status})
+        except Exception as e:
+            print(f"Error importing bundle {file.filename}: {e}")
+            rejected.append({'filename': file.filename, 'error': str(e), 'status': 500})
+    if not imported:
+        status = rejected[0]['status'] if len(rejected) == 1 else 400
+        return jsonify({'error': 'No bundles imported', 'rejected': rejected}), status
+    return jsonify({'documents': imported, 'rejected': rejected})
+
 @app.route('/api/documents/<document_id>', methods=['DELETE'])
 def delete_document(document_id):
     """Delete a document and its associated data"""
     try:
-        # Check if document exists in retrievers
-        if document_id not in retrievers:
+        # Check the document exists and belongs to the caller's tenant
+        if not document_visible(document_id, get_request_tenant()):
             return jsonify({'error': 'Document not found'}), 404
         
         # Remove from retrievers
         del retrievers[document_id]
+        document_tenants.pop(document_id, None)
         
         # Remove conversation history
         if document_id in conversation_histories:
             del conversation_histories[document_id]
         
-        # Delete the Chroma collection
+        # Delete the document's vectors (shared collection filter or own collection)
         try:
-            import chromadb
-            client = chromadb.PersistentClient(path="chroma_db")
-            collection_name = f"doc_{document_id}"
-            client.delete_collection(collection_name)
-            print(f"Deleted Chroma collection: {collection_name}")
+            delete_document_vectors(document_id)
         except Exception as e:
-            print(f"Error deleting Chroma collection: {e}")
+            print(f"Error deleting Chroma vectors: {e}")
         
         # Delete the uploaded file
         try:
-            import glob
-            file_pattern = os.path.join(UPLOAD_FOLDER, f"{document_id}_*")
-            files = glob.glob(file_pattern)
+            files = glob.glob(os.path.join(UPLOAD_FOLDER, f"{document_id}_*"))
+            files += glob.glob(os.path.join(OPTIMIZED_FOLDER, f"{document_id}_*"))
             for file_path in files:
                 if os.path.exists(file_path):
                     os.remove(file_path)
+                    file_hashes.pop(file_path, None)
                     print(f"Deleted file: {file_path}")
         except Exception as e:
             print(f"Error deleting file: {e}")
@@ -875,6 +2684,34 @@ def delete_document(document_id):
         print(f"Error deleting document: {e}")
         return jsonify({'error': f'Failed to delete document: {str(e)}'}), 500
 
+@app.route('/api/admin/migrate-storage', methods=['POST'])
+def migrate_storage():
+    """Move legacy per-document collections into the tenant's shared collection"""
+    try:
+        migrated = migrate_to_shared_storage(get_request_tenant())
+        return jsonify({'migrated': migrated, 'count': len(migrated)})
+    except Exception as e:
+        print(f"Error migrating storage: {e}")
+        return jsonify({'error': f'Migration failed: {str(e)}'}), 500
+
+@app.route('/api/admin/storage-gc', methods=['POST'])
+def run_storage_gc():
+    """Remove orphaned files and vectors and compact storage now (`?dry_run=1` only reports)"""
+    dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
+    try:
+        report = collect_storage_garbage(dry_run=dry_run)
+    except Exception as e:
+        print(f"Error running storage GC: {e}")
+        return jsonify({'error': f'Storage GC failed: {str(e)}'}), 500
+    if report is None:
+        return jsonify({'error': 'Storage GC is already running'}), 409
+    return jsonify(report)
+
+@app.route('/api/admin/storage-gc', methods=['GET'])
+def get_storage_gc():
+    """Report from the last storage GC pass that changed anything (not dry runs)"""
+    return jsonify(storage_state.get('last_gc') or {})
+
 @app.route('/api/feedback', methods=['POST'])
 def submit_feedback():
     """Submit user feedback for an answer"""
@@ -909,5 +2746,4 @@ def submit_feedback():
 
 if __name__ == '__main__':
     # Configure Flask for better Windows compatibility
-    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
     app.run(debug=True, port=5000, use_reloader=False, threaded=True)
\ No newline at end of file
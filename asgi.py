@@ -0,0 +1,296 @@
+"""Async (ASGI) serving mode for the PDF chat app.
+
+Serves the same routes as app.py, but chat retrieval, query embedding and the
+DeepSeek stream are awaited instead of holding a thread per request. CPU-bound
+work (PDF parsing, OCR, chunking, HTML formatting) and local Chroma queries run
+in a thread pool. Routes without a dedicated async handler fall through to the
+Flask app, so both modes share the same retrievers and chat histories.
+
+Run with:
+    uvicorn asgi:asgi_app --port 5000
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.utils import secure_filename
+
+import app as flask_app
+from app import (
+    CHAT_FALLBACK_K,
+    Overloaded,
+    PRIORITY_INTERACTIVE,
+    STREAM_HEADERS,
+    UPLOAD_FOLDER,
+    allowed_file,
+    build_chat_request,
+    chat_admission,
+    chat_flights,
+    chat_retrieval_queries,
+    classify_message,
+    coalesce_key,
+    deepseek_headers,
+    document_visible,
+    format_response_text,
+    ingest_scheduler,
+    is_stream_done,
+    merge_retrieved,
+    normalize_tenant,
+    parse_stream_line,
+    prepare_upload_for_serving,
+    retrievers,
+    save_exchange,
+)
+from markdown_render import MarkdownRenderer
+
+# One pooled client for all upstream LLM calls; per-request clients would
+# re-handshake TLS for every chat.
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(120.0, connect=10.0),
+    limits=httpx.Limits(max_connections=int(os.getenv("ASGI_MAX_UPSTREAM_CONNECTIONS", "500"))),
+)
+
+
+# Streaming producers outlive the request that started them; keep references so
+# they aren't garbage collected mid-stream
+background_tasks = set()
+
+
+def request_tenant(request, form=None):
+    tenant = request.headers.get('X-Tenant-Id') or (form.get('tenant') if form else None) or request.query_params.get('tenant')
+    return normalize_tenant(tenant)
+
+
+async def aretrieve(retriever, query, k=None):
+    """Embed the query asynchronously, then run the Chroma lookup in the thread pool"""
+    vector_store = retriever.vectorstore
+    search_kwargs = retriever.search_kwargs
+    query_embedding = await vector_store.embeddings.aembed_query(query)
+    return await run_in_threadpool(
+        vector_store.similarity_search_by_vector,
+        query_embedding,
+        k=k or search_kwargs.get("k", 5),
+        filter=search_kwargs.get("filter"),
+    )
+
+
+async def aretrieve_chat_docs(retriever, message, intent):
+    """Awaited counterpart of app.retrieve_chat_docs: same queries, same fallback"""
+    results = [await aretrieve(retriever, query) for query in chat_retrieval_queries(message, intent)]
+    relevant_docs = merge_retrieved(results)
+    if not relevant_docs:
+        relevant_docs = await aretrieve(retriever, message, k=CHAT_FALLBACK_K)
+    return relevant_docs
+
+
+async def prepare_chat(message, document_id, stream=False):
+    """Classify the message, retrieve context and build the DeepSeek payload.
+    Returns (chat_history, payload, response_meta).
+    """
+    intent = classify_message(message)
+    relevant_docs = await aretrieve_chat_docs(retrievers[document_id], message, intent)
+    return build_chat_request(message, document_id, intent, relevant_docs, stream=stream)
+
+
+async def read_chat_request(request):
+    data = await request.json()
+    message = data.get('message')
+    document_id = data.get('documentId')
+    if not message:
+        return None, None, JSONResponse({'error': 'No message provided'}, status_code=400)
+    if not document_visible(document_id, request_tenant(request)):
+        return None, None, JSONResponse({'error': 'Document not found'}, status_code=404)
+    return message, document_id, None
+
+
+def overloaded_response(error):
+    return JSONResponse({'error': str(error)}, status_code=503, headers={'Retry-After': str(error.retry_after)})
+
+
+async def answer_chat(message, document_id):
+    chat_history, payload, response_meta = await prepare_chat(message, document_id)
+    r = await http_client.post(flask_app.DEEPSEEK_API_URL, headers=deepseek_headers(), json=payload)
+    if r.status_code != 200:
+        raise Exception(f"API call failed: {r.status_code} - {r.text}")
+    response = r.json()["choices"][0]["message"]["content"]
+
+    formatted_response = await run_in_threadpool(format_response_text, response)
+    save_exchange(document_id, chat_history, message, formatted_response, response_meta)
+    return dict(response_meta, response=formatted_response)
+
+
+async def chat(request: Request):
+    message, document_id, error = await read_chat_request(request)
+    if error:
+        return error
+
+    # Identical questions already in flight (in either serving mode) share one computation
+    flight, is_leader = chat_flights.join(coalesce_key(document_id, message, 'full'))
+    if is_leader:
+        try:
+            await chat_admission.aacquire(document_id)
+        except Overloaded as e:
+            chat_flights.fail(flight, e)
+            return overloaded_response(e)
+        started = time.monotonic()
+        try:
+            chat_flights.finish(flight, await answer_chat(message, document_id))
+        except Exception as e:
+            chat_flights.fail(flight, e)
+        finally:
+            chat_admission.release(document_id, time.monotonic() - started)
+    else:
+        await flight.await_done()
+
+    if isinstance(flight.error, Overloaded):
+        return overloaded_response(flight.error)
+    if flight.error is not None:
+        print(f"Error: {flight.error}")
+        return JSONResponse({'error': f'An error occurred: {str(flight.error)}'}, status_code=500)
+    return JSONResponse(flight.result)
+
+
+async def run_stream_flight(flight, message, document_id):
+    """Producer task for a streaming flight; independent of any one client connection"""
+    started = time.monotonic()
+    try:
+        try:
+            chat_history, payload, response_meta = await prepare_chat(message, document_id, stream=True)
+        except Exception as e:
+            chat_flights.fail(flight, e)
+            return
+        flight.start()
+
+        # Rendering per token is cheap and linear, so it stays on the event loop
+        renderer = MarkdownRenderer()
+        rendered = []
+        try:
+            async with http_client.stream("POST", flask_app.DEEPSEEK_API_URL, headers=deepseek_headers(), json=payload) as r:
+                r.raise_for_status()
+                async for line in r.aiter_lines():
+                    if is_stream_done(line):
+                        break
+                    content = parse_stream_line(line)
+                    if content:
+                        rendered.append(renderer.feed(content))
+                        flight.publish(content)
+        except Exception as e:
+            flight.publish(f"\n[Stream error: {str(e)}]")
+
+        try:
+            rendered.append(renderer.close())
+            save_exchange(document_id, chat_history, message, ''.join(rendered), response_meta)
+        except Exception:
+            pass
+
+        flight.publish("\n[[SOURCES]]" + json.dumps(response_meta))
+        chat_flights.finish(flight)
+    except Exception as e:
+        chat_flights.fail(flight, e)
+    finally:
+        chat_admission.release(document_id, time.monotonic() - started)
+
+
+async def chat_stream(request: Request):
+    message, document_id, error = await read_chat_request(request)
+    if error:
+        return error
+
+    flight, is_leader = chat_flights.join(coalesce_key(document_id, message, 'stream'))
+    if is_leader:
+        try:
+            await chat_admission.aacquire(document_id)
+        except Overloaded as e:
+            chat_flights.fail(flight, e)
+            return overloaded_response(e)
+        task = asyncio.create_task(run_stream_flight(flight, message, document_id))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+    await flight.await_started()
+    if isinstance(flight.error, Overloaded):
+        return overloaded_response(flight.error)
+    if flight.error is not None and not flight.chunks:
+        return JSONResponse({'error': str(flight.error)}, status_code=500)
+    return StreamingResponse(flight.aiter_chunks(), headers=STREAM_HEADERS)
+
+
+async def wait_for_job(job):
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+    ingest_scheduler.add_done_callback(job, lambda _: loop.call_soon_threadsafe(finished.set_result, None))
+    await finished
+
+
+async def upload(request: Request):
+    form = await request.form()
+    file = form.get('file')
+    if file is None or not hasattr(file, 'filename'):
+        return JSONResponse({'error': 'No file provided'}, status_code=400)
+    if file.filename == '':
+        return JSONResponse({'error': 'No file selected'}, status_code=400)
+    if not allowed_file(file.filename):
+        return JSONResponse({'error': 'Invalid file type'}, status_code=400)
+
+    doc_id = str(uuid.uuid4())
+    original_filename = secure_filename(file.filename)
+    filename = f"{doc_id}_{original_filename}"
+    filepath = os.path.join(UPLOAD_FOLDER, filename)
+    tenant = request_tenant(request, form)
+
+    try:
+        contents = await file.read()
+        await run_in_threadpool(_write_file, filepath, contents)
+    except Exception as e:
+        print(f"Error saving file: {e}")
+        return JSONResponse({'error': f'Failed to save file: {str(e)}'}, status_code=500)
+
+    # Same prioritized pipeline as the Flask route; await completion without holding a thread
+    job = ingest_scheduler.submit(filepath, doc_id, filename, tenant=tenant, priority=PRIORITY_INTERACTIVE)
+    # Overlaps with ingest; finishes before the filename is handed out
+    await run_in_threadpool(prepare_upload_for_serving, filepath)
+    await wait_for_job(job)
+    if job['status'] == 'failed':
+        print(f"Ingest failed for {original_filename}: {job['error']}")
+        return JSONResponse({'error': job['error']}, status_code=500)
+
+    print(f"Upload successful for: {original_filename}")
+    return JSONResponse({
+        'id': doc_id,
+        'filename': original_filename,
+        'server_filename': filename,
+        'message': 'File uploaded and processed successfully'
+    })
+
+
+def _write_file(filepath, contents):
+    with open(filepath, 'wb') as f:
+        f.write(contents)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await http_client.aclose()
+
+
+asgi_app = Starlette(
+    routes=[
+        Route('/api/chat', chat, methods=['POST']),
+        Route('/api/chat/stream', chat_stream, methods=['POST']),
+        Route('/api/upload', upload, methods=['POST']),
+        # Everything else (pages, uploads, history, deletes, admin) is served by Flask
+        Mount('/', app=WSGIMiddleware(flask_app.app)),
+    ],
+    lifespan=lifespan,
+)
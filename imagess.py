@@ -1,54 +1,414 @@
-import fitz  
-import pytesseract
-from PIL import Image
+"""Offline batch OCR for embedded PDF images.
+
+Walks a directory of PDFs with a process pool, OCRs every embedded image
+straight from memory and appends one JSON line per PDF to a manifest. Records
+are keyed by the SHA-256 of the PDF bytes, so:
+
+- re-running the command skips PDFs that are already in the manifest, and a
+  crash loses at most the PDFs that were still in progress;
+- the app (see OCR_MANIFEST_PATH in app.py) reuses the OCR text when the same
+  file is uploaded later instead of running Tesseract again.
+
+Usage:
+    python imagess.py pdfs/ --manifest ocr_manifest.jsonl --workers 4
+    python imagess.py pdfs/ --images-dir extracted_images   # also keep the raw images
+"""
+import argparse
+import concurrent.futures
+import glob
+import hashlib
 import io
+import json
+import math
 import os
+import time
+
+try:
+    import fitz  # PyMuPDF
+except Exception:
+    fitz = None
+try:
+    import pytesseract
+    from PIL import Image
+except Exception:
+    pytesseract = None
+    Image = None
+
+MANIFEST_VERSION = 1
+DEFAULT_MANIFEST = "ocr_manifest.jsonl"
+
+# Preprocessing: images smaller than OCR_MIN_SIDE px on a side, or flatter than
+# OCR_MIN_ENTROPY bits (blank areas, rules, solid fills), are not OCRed. Black
+# text on white with ~5% ink is about 0.3 bits, so keep the threshold low.
+OCR_MIN_SIDE = int(os.getenv("OCR_MIN_SIDE", "32"))
+OCR_MIN_ENTROPY = float(os.getenv("OCR_MIN_ENTROPY", "0.2"))
+OCR_TARGET_DPI = int(os.getenv("OCR_TARGET_DPI", "300"))
+OCR_MIN_SCALE = 0.25
+OCR_MAX_SCALE = 4.0
+OCR_MAX_PIXELS = int(os.getenv("OCR_MAX_PIXELS", str(16 * 1024 * 1024)))
+# Tesseract page segmentation mode; "auto" uses 7 (single line) for strips, else 3
+OCR_PSM = os.getenv("OCR_PSM", "auto")
+# Seconds; 0 disables the limit
+OCR_IMAGE_TIMEOUT = float(os.getenv("OCR_IMAGE_TIMEOUT", "15"))
+OCR_DOCUMENT_BUDGET = float(os.getenv("OCR_DOCUMENT_BUDGET", "120"))
+OCR_COUNTERS = ('processed', 'skipped_small', 'skipped_low_entropy', 'skipped_budget', 'timed_out', 'failed')
+
+
+def configure_tesseract(cmd=None):
+    """Point pytesseract at TESSERACT_CMD (or `cmd`) when set; otherwise use PATH"""
+    cmd = cmd or os.getenv('TESSERACT_CMD')
+    if pytesseract is not None and cmd:
+        pytesseract.pytesseract.tesseract_cmd = cmd
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def image_entropy(image):
+    """Shannon entropy (bits) of a grayscale image's histogram; blank or flat images score near 0"""
+    histogram = image.histogram()
+    total = float(sum(histogram))
+    return -sum(c / total * math.log2(c / total) for c in histogram if c)
+
+
+def otsu_threshold(image):
+    """Global threshold that best separates the two modes of a grayscale histogram"""
+    histogram = image.histogram()
+    total = sum(histogram)
+    weighted_total = sum(i * c for i, c in enumerate(histogram))
+    best, best_variance = 127, -1.0
+    background = weighted_background = 0
+    for level, count in enumerate(histogram):
+        background += count
+        if background == 0:
+            continue
+        foreground = total - background
+        if foreground == 0:
+            break
+        weighted_background += level * count
+        mean_bg = weighted_background / background
+        mean_fg = (weighted_total - weighted_background) / foreground
+        variance = background * foreground * (mean_bg - mean_fg) ** 2
+        if variance > best_variance:
+            best, best_variance = level, variance
+    return best
+
+
+class OcrSession:
+    """Preprocesses and OCRs the images of one document within a time budget.
+
+    Each image is filtered (too small, or too little entropy to hold text),
+    rescaled to OCR_TARGET_DPI using the size it is drawn at on the page,
+    converted to grayscale and binarized with an Otsu threshold before
+    Tesseract sees it. Tesseract gets at most OCR_IMAGE_TIMEOUT seconds per
+    image and the document as a whole OCR_DOCUMENT_BUDGET seconds; images
+    left once the budget is spent are skipped. `counts` records what
+    happened to every image.
+    """
+
+    def __init__(self, budget=None, image_timeout=None):
+        self.budget = OCR_DOCUMENT_BUDGET if budget is None else budget
+        self.image_timeout = OCR_IMAGE_TIMEOUT if image_timeout is None else image_timeout
+        self.deadline = time.monotonic() + self.budget if self.budget > 0 else None
+        self.counts = dict.fromkeys(OCR_COUNTERS, 0)
+
+    def _timeout(self):
+        """Seconds Tesseract may spend on the next image (0 = no limit, None = budget spent)"""
+        if self.deadline is None:
+            return self.image_timeout
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        return min(self.image_timeout, remaining) if self.image_timeout > 0 else remaining
+
+    def ocr(self, image_bytes, display_size=None):
+        """OCR an encoded image held in memory; returns stripped text ('' if none or skipped).
+        `display_size` is the (width, height) in points the image is drawn at, if known.
+        """
+        if not image_bytes:
+            return ""
+        timeout = self._timeout()
+        if timeout is None:
+            self.counts['skipped_budget'] += 1
+            return ""
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                prepared = self._prepare(image, display_size)
+                if prepared is None:
+                    return ""
+            psm, page = prepared
+            text = pytesseract.image_to_string(page, config=f'--psm {psm}', timeout=timeout)
+        except RuntimeError as e:
+            # pytesseract kills the process and raises RuntimeError on timeout
+            if 'timeout' not in str(e).lower():
+                self.counts['failed'] += 1
+                raise
+            self.counts['timed_out'] += 1
+            return ""
+        except Exception:
+            self.counts['failed'] += 1
+            raise
+        self.counts['processed'] += 1
+        return (text or "").strip()
+
+    def _prepare(self, image, display_size):
+        """Return (psm, preprocessed image), or None if the image is not worth OCRing"""
+        width, height = image.size
+        if min(width, height) < OCR_MIN_SIDE:
+            self.counts['skipped_small'] += 1
+            return None
+
+        scale = 1.0
+        if display_size and display_size[0] > 0:
+            effective_dpi = width * 72.0 / display_size[0]
+            scale = min(max(OCR_TARGET_DPI / effective_dpi, OCR_MIN_SCALE), OCR_MAX_SCALE)
+        if width * height * scale * scale > OCR_MAX_PIXELS:
+            scale = math.sqrt(OCR_MAX_PIXELS / float(width * height))
+        target = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+        if scale < 1.0:
+            # Lets the JPEG decoder skip most of the work on large photos
+            image.draft('L', target)
+        gray = image.convert('L')
+
+        probe = gray.copy()
+        probe.thumbnail((256, 256))
+        if image_entropy(probe) < OCR_MIN_ENTROPY:
+            self.counts['skipped_low_entropy'] += 1
+            return None
 
+        if gray.size != target:
+            gray = gray.resize(target, Image.LANCZOS if scale < 1.0 else Image.BICUBIC)
+        threshold = otsu_threshold(gray)
+        binary = gray.point(lambda p: 255 if p > threshold else 0)
 
-pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+        psm = OCR_PSM
+        if psm == 'auto':
+            # A wide, short strip is almost always a single line of text (a caption or label)
+            psm = '7' if target[0] >= 6 * target[1] and target[1] <= 200 else '3'
+        return psm, binary
 
-def extract_all_images(pdf_path, output_dir="extracted_images"):
-    """Extract all images from a PDF and save them locally"""
-    os.makedirs(output_dir, exist_ok=True)
-    doc = fitz.open(pdf_path)
-    image_list = []
 
+def page_image_sizes(page):
+    """Map image xref -> (width, height) in points as drawn on the page (largest placement)"""
+    sizes = {}
+    try:
+        infos = page.get_image_info(xrefs=True)
+    except Exception:
+        return sizes
+    for info in infos:
+        x0, y0, x1, y1 = info['bbox']
+        size = (abs(x1 - x0), abs(y1 - y0))
+        if info.get('xref') and size[0] > sizes.get(info['xref'], (0, 0))[0]:
+            sizes[info['xref']] = size
+    return sizes
+
+
+def extract_all_images(doc, output_dir=None):
+    """Yield every embedded image of an open PDF as a dict with its raw bytes.
+    Images are yielded per page in order, so one xref shared by several pages
+    appears once per page. With `output_dir`, the original bytes are also
+    written there unchanged.
+    """
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
     for page_index, page in enumerate(doc):
-        images = page.get_images(full=True)
-        print(f"📄 Page {page_index + 1}: Found {len(images)} image(s).")
-        for img_index, img in enumerate(images):
+        label = page.get_label() or str(page_index + 1)
+        display_sizes = page_image_sizes(page)
+        for img_index, img in enumerate(page.get_images(full=True)):
             xref = img[0]
             base_image = doc.extract_image(xref)
-            image_bytes = base_image["image"]
-            image_ext = base_image["ext"]
-            image = Image.open(io.BytesIO(image_bytes))
-
-            filename = f"page{page_index+1}_img{img_index+1}.{image_ext}"
-            filepath = os.path.join(output_dir, filename)
-            image.save(filepath)
-            print(f"✅ Saved: {filename}")
-            image_list.append(filepath)
-    
-    if not image_list:
-        print("⚠️ No images found in the entire PDF.")
-    return image_list
-
-
-def analyze_images_with_ocr(image_paths):
-    """Run OCR on all extracted images"""
-    for path in image_paths:
-        print(f"\n🔍 Analyzing: {path}")
-        image = Image.open(path)
-        ocr_text = pytesseract.image_to_string(image)
-        print("🧠 OCR Detected Text:")
-        print("--------------------")
-        print(ocr_text.strip() if ocr_text.strip() else "No text detected.")
-        print("--------------------")
+            if not base_image or not base_image.get("image"):
+                continue
+            if output_dir:
+                name = f"page{page_index+1}_img{img_index+1}.{base_image['ext']}"
+                with open(os.path.join(output_dir, name), 'wb') as f:
+                    f.write(base_image["image"])
+            yield {
+                'page': page_index,
+                'page_label': label,
+                'image_index': img_index + 1,
+                'xref': xref,
+                'ext': base_image.get("ext"),
+                'width': base_image.get("width"),
+                'height': base_image.get("height"),
+                'display_size': display_sizes.get(xref),
+                'image': base_image["image"],
+            }
 
 
-if __name__ == "__main__":
-    pdf_path = "pdf-example-bookmarks.pdf"  
-    image_paths = extract_all_images(pdf_path)
-    if image_paths:
-        analyze_images_with_ocr(image_paths)
+def analyze_images_with_ocr(images, session=None):
+    """OCR image dicts from extract_all_images; returns the ones with text, minus the bytes.
+    Each xref is OCRed once even when it repeats across pages. Pass an
+    OcrSession to share its time budget and counters.
+    """
+    session = session or OcrSession()
+    results = []
+    cache = {}
+    for image in images:
+        xref = image['xref']
+        if xref not in cache:
+            try:
+                cache[xref] = session.ocr(image['image'], image.get('display_size'))
+            except Exception as e:
+                print(f"OCR failed on page {image['page']+1} image {image['image_index']}: {e}")
+                cache[xref] = ""
+        if cache[xref]:
+            record = {k: v for k, v in image.items() if k not in ('image', 'display_size')}
+            record['text'] = cache[xref]
+            results.append(record)
+    return results
+
+
+def process_pdf(pdf_path, sha256, images_dir=None):
+    """Extract and OCR one PDF; returns its manifest record (never raises)"""
+    started = time.monotonic()
+    record = {
+        'version': MANIFEST_VERSION,
+        'sha256': sha256,
+        'source': pdf_path,
+        'filename': os.path.basename(pdf_path),
+    }
+    try:
+        doc = fitz.open(pdf_path)
+        try:
+            out_dir = None
+            if images_dir:
+                out_dir = os.path.join(images_dir, os.path.splitext(os.path.basename(pdf_path))[0])
+            record['pages'] = doc.page_count
+            session = OcrSession()
+            record['images'] = analyze_images_with_ocr(extract_all_images(doc, out_dir), session)
+            record['ocr'] = session.counts
+        finally:
+            doc.close()
+        record['status'] = 'done'
+    except Exception as e:
+        record['status'] = 'failed'
+        record['error'] = str(e)
+    record['seconds'] = round(time.monotonic() - started, 3)
+    record['processed_at'] = time.time()
+    return record
+
+
+def load_manifest(path):
+    """Read a manifest into {sha256: record}; later lines win.
+    A truncated last line (from a crash mid-write) is ignored.
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('version') == MANIFEST_VERSION and record.get('sha256'):
+                records[record['sha256']] = record
+    return records
+
+
+def append_manifest(f, record):
+    """Append one record and force it to disk so a restart sees it"""
+    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _terminate_partial_line(path):
+    """End a line left half-written by a crash so the next record starts cleanly"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb+') as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
 
+def _init_worker(tesseract_cmd):
+    # Tesseract's own OpenMP threads would oversubscribe the CPUs next to the pool
+    os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+    configure_tesseract(tesseract_cmd)
+
+
+def find_pdfs(directory, recursive=False):
+    pattern = os.path.join(directory, '**', '*') if recursive else os.path.join(directory, '*')
+    return sorted(p for p in glob.glob(pattern, recursive=recursive)
+                  if p.lower().endswith('.pdf') and os.path.isfile(p))
+
+
+def run_batch(pdf_paths, manifest_path, workers=None, images_dir=None, force=False, tesseract_cmd=None):
+    """OCR every PDF not already done in the manifest. Returns (processed, skipped, failed)."""
+    done = {sha for sha, r in load_manifest(manifest_path).items() if r.get('status') == 'done'}
+    pending = {}
+    skipped = 0
+    for path in pdf_paths:
+        sha256 = file_sha256(path)
+        if (sha256 in done and not force) or sha256 in pending:
+            skipped += 1
+            continue
+        pending[sha256] = path
+    print(f"{len(pending)} PDF(s) to OCR, {skipped} already in {manifest_path}")
+    if not pending:
+        return 0, skipped, 0
+
+    processed = failed = 0
+    _terminate_partial_line(manifest_path)
+    with open(manifest_path, 'a', encoding='utf-8') as manifest, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                   initargs=(tesseract_cmd,)) as pool:
+        futures = {pool.submit(process_pdf, path, sha256, images_dir): path for sha256, path in pending.items()}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                # Worker process died (e.g. killed); leave it out so the next run retries it
+                print(f"❌ {path}: {e}")
+                failed += 1
+                continue
+            append_manifest(manifest, record)
+            if record['status'] == 'done':
+                processed += 1
+                counts = record['ocr']
+                print(f"✅ {path}: {record['pages']} page(s), {len(record['images'])} image(s) with text, "
+                      f"{counts['skipped_small'] + counts['skipped_low_entropy']} skipped, "
+                      f"{counts['timed_out'] + counts['skipped_budget']} cut by time limits, in {record['seconds']}s")
+            else:
+                failed += 1
+                print(f"❌ {path}: {record['error']}")
+    return processed, skipped, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='directory containing PDFs')
+    parser.add_argument('--manifest', default=os.getenv('OCR_MANIFEST_PATH', DEFAULT_MANIFEST))
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--recursive', action='store_true', help='also look in subdirectories')
+    parser.add_argument('--images-dir', help='also save the raw extracted images here')
+    parser.add_argument('--force', action='store_true', help='re-OCR PDFs already in the manifest')
+    parser.add_argument('--tesseract-cmd', help='tesseract binary (default: TESSERACT_CMD or PATH)')
+    args = parser.parse_args()
+
+    if fitz is None or pytesseract is None or Image is None:
+        parser.error('PyMuPDF, pytesseract and Pillow are required')
+    pdf_paths = find_pdfs(args.directory, args.recursive)
+    if not pdf_paths:
+        parser.error(f'no PDFs found in {args.directory}')
+
+    started = time.monotonic()
+    processed, skipped, failed = run_batch(pdf_paths, args.manifest, args.workers, args.images_dir,
+                                           args.force, args.tesseract_cmd)
+    print(f"Done in {time.monotonic() - started:.1f}s: {processed} processed, {skipped} skipped, {failed} failed")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Concurrent streaming load test against a local fake LLM.
+
+1. Start the fake DeepSeek/Mistral server:
+       python loadtest.py fake-llm --port 8001
+
+2. Start the app pointed at it, either threaded Flask or the ASGI mode. Every
+   stream asks about the same document, so raise the chat admission caps to
+   the test's concurrency; with the defaults (32 at once, 8 per document) most
+   streams are queued or rejected with 503 instead of running concurrently:
+       DEEPSEEK_API_URL=http://127.0.0.1:8001/v1/chat/completions \\
+       MISTRAL_API_URL=http://127.0.0.1:8001/v1/ MISTRAL_API_KEY=fake \\
+       CHAT_MAX_CONCURRENT=200 CHAT_MAX_PER_DOCUMENT=200 \\
+       python app.py                                   # or: uvicorn asgi:asgi_app --port 5000
+
+3. Fire concurrent /api/chat/stream requests and compare the numbers:
+       python loadtest.py run --target http://127.0.0.1:5000 --concurrency 200
+
+   The run reads the server's caps from /api/chat/admission first and says
+   which CHAT_MAX_* settings it needs. Streams rejected by admission control
+   (503) are counted apart from real failures.
+"""
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
+import statistics
+import time
+
+import httpx
+
+EMBEDDING_DIM = 1024
+
+
+def fake_embedding(text):
+    """Deterministic pseudo-embedding so retrieval behaves consistently between runs"""
+    digest = hashlib.sha256(text.encode('utf-8')).digest()
+    return [((digest[i % len(digest)] + i) % 255) / 255.0 for i in range(EMBEDDING_DIM)]
+
+
+def build_fake_llm(tokens, token_delay):
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Route
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        words = [f"token{i} " for i in range(tokens)]
+        if not body.get('stream'):
+            await asyncio.sleep(token_delay * tokens)
+            return JSONResponse({'choices': [{'message': {'role': 'assistant', 'content': ''.join(words)}}]})
+
+        async def events():
+            for word in words:
+                await asyncio.sleep(token_delay)
+                yield 'data: ' + json.dumps({'choices': [{'delta': {'content': word}}]}) + '\n\n'
+            yield 'data: [DONE]\n\n'
+
+        return StreamingResponse(events(), media_type='text/event-stream')
+
+    async def create_embeddings(request: Request):
+        body = await request.json()
+        inputs = body.get('input') or []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        return JSONResponse({
+            'object': 'list',
+            'model': body.get('model', 'mistral-embed'),
+            'data': [{'object': 'embedding', 'index': i, 'embedding': fake_embedding(text)} for i, text in enumerate(inputs)],
+            'usage': {'prompt_tokens': 0, 'total_tokens': 0},
+        })
+
+    return Starlette(routes=[
+        Route('/v1/chat/completions', chat_completions, methods=['POST']),
+        Route('/v1/embeddings', create_embeddings, methods=['POST']),
+    ])
+
+
+async def upload_document(client, target, pdf_path):
+    with open(pdf_path, 'rb') as f:
+        files = {'file': (pdf_path.rsplit('/', 1)[-1], f.read(), 'application/pdf')}
+    r = await client.post(f"{target}/api/upload", files=files)
+    r.raise_for_status()
+    return r.json()['id']
+
+
+async def one_stream(client, target, document_id, question):
+    started = time.perf_counter()
+    first_byte = None
+    size = 0
+    async with client.stream('POST', f"{target}/api/chat/stream", json={'message': question, 'documentId': document_id}) as r:
+        r.raise_for_status()
+        async for chunk in r.aiter_text():
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            size += len(chunk)
+    return first_byte or 0.0, time.perf_counter() - started, size
+
+
+async def check_admission_limits(client, target, concurrency):
+    """Warn when the server's chat admission caps won't let every stream run at once"""
+    try:
+        r = await client.get(f"{target}/api/chat/admission")
+        r.raise_for_status()
+        limits = r.json()['limits']
+    except Exception as e:
+        print(f"Could not read admission limits: {e}")
+        return
+    # All streams target one document, so the per-document cap applies to all of them
+    running = min(limits['max_concurrent'], limits['max_per_document'])
+    print(f"Admission limits:   {limits['max_concurrent']} concurrent, {limits['max_per_document']} per document, "
+          f"queue {limits['max_queue']}, wait {limits['queue_timeout']}s")
+    if running < concurrency:
+        print(f"Only {running} of {concurrency} streams can run at once; the rest queue or get 503.")
+        print(f"Restart the server with CHAT_MAX_CONCURRENT={concurrency} CHAT_MAX_PER_DOCUMENT={concurrency} "
+              f"to measure {concurrency} concurrent streams.")
+
+
+def is_rejected(result):
+    return isinstance(result, httpx.HTTPStatusError) and result.response.status_code == 503
+
+
+async def run_load(target, concurrency, document_id, pdf_path):
+    limits = httpx.Limits(max_connections=concurrency + 10)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(600.0), limits=limits) as client:
+        await check_admission_limits(client, target, concurrency)
+        if not document_id:
+            document_id = await upload_document(client, target, pdf_path)
+            print(f"Uploaded {pdf_path} as {document_id}")
+
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(one_stream(client, target, document_id, f"What does the document say about topic {i}?") for i in range(concurrency)),
+            return_exceptions=True,
+        )
+        elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if not isinstance(r, Exception)]
+    rejected = sum(1 for r in results if is_rejected(r))
+    failed = len(results) - len(ok) - rejected
+    print(f"Target:            {target}")
+    print(f"Concurrent streams: {concurrency} ({len(ok)} completed, {rejected} rejected with 503, {failed} failed)")
+    print(f"Wall time:          {elapsed:.2f}s")
+    if ok:
+        ttfb = sorted(r[0] for r in ok)
+        totals = sorted(r[1] for r in ok)
+        print(f"Time to first byte: p50 {statistics.median(ttfb):.2f}s  p95 {ttfb[int(len(ttfb) * 0.95) - 1]:.2f}s")
+        print(f"Stream duration:    p50 {statistics.median(totals):.2f}s  p95 {totals[int(len(totals) * 0.95) - 1]:.2f}s")
+        print(f"Streams/sec:        {len(ok) / elapsed:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    fake = sub.add_parser('fake-llm', help='serve a fake DeepSeek chat + Mistral embeddings API')
+    fake.add_argument('--port', type=int, default=8001)
+    fake.add_argument('--tokens', type=int, default=200, help='tokens per streamed answer')
+    fake.add_argument('--token-delay', type=float, default=0.02, help='seconds between tokens')
+
+    run = sub.add_parser('run', help='fire concurrent streaming chats at a running app')
+    run.add_argument('--target', default='http://127.0.0.1:5000')
+    run.add_argument('--concurrency', type=int, default=200)
+    run.add_argument('--document-id', help='existing document id (skips the upload)')
+    run.add_argument('--pdf', help='PDF to upload when no --document-id is given')
+
+    args = parser.parse_args()
+    if args.command == 'fake-llm':
+        import uvicorn
+        uvicorn.run(build_fake_llm(args.tokens, args.token_delay), host='127.0.0.1', port=args.port, log_level='warning')
+    else:
+        pdf_path = args.pdf or next(iter(sorted(glob.glob('uploads/*.pdf'))), None)
+        if not args.document_id and not pdf_path:
+            parser.error('pass --document-id or --pdf')
+        asyncio.run(run_load(args.target.rstrip('/'), args.concurrency, args.document_id, pdf_path))
+
+
+if __name__ == '__main__':
+    main()
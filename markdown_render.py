@@ -0,0 +1,262 @@
+"""Single-pass, streaming markdown-to-HTML renderer for chat answers.
+
+Handles headings, bold/italic, inline code, nested ordered/unordered lists,
+fenced code blocks, pipe tables and horizontal rules. Every line is looked at
+once and all text is HTML-escaped, so rendering is linear in the answer length
+and can run incrementally while tokens arrive:
+
+    renderer = MarkdownRenderer()
+    html = renderer.feed(token) + ... + renderer.close()
+
+Run this file directly for a micro-benchmark of the scaling behaviour.
+"""
+import html
+import re
+
+HEADING = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+LIST_ITEM = re.compile(r'^([ \t]*)([-*+]|\d{1,9}[.)])\s+(.*)$')
+FENCE = re.compile(r'^\s*(```|~~~)\s*([\w+#-]*)')
+HORIZONTAL_RULE = re.compile(r'^(?:-[ \t]*){3,}$|^(?:\*[ \t]*){3,}$|^(?:_[ \t]*){3,}$')
+TABLE_SEPARATOR = re.compile(r'^\s*\|?\s*:?-{3,}:?\s*(?:\|\s*:?-{3,}:?\s*)*\|?\s*$')
+INLINE_CODE = re.compile(r'`([^`]+)`')
+BOLD = re.compile(r'\*\*(.+?)\*\*')
+ITALIC = re.compile(r'(?<![*\w])\*(?![\s*])(.+?)(?<![\s*])\*(?!\*)')
+
+
+def _emphasis(text):
+    if '*' not in text:
+        return text
+    text = BOLD.sub(r'<strong>\1</strong>', text)
+    return ITALIC.sub(r'<em>\1</em>', text)
+
+
+def render_inline(text):
+    """Escape a line of text and apply inline code and emphasis markup"""
+    text = html.escape(text, quote=False)
+    if '`' not in text:
+        return _emphasis(text)
+    # split() puts code span contents at odd indices; leave those unformatted
+    parts = INLINE_CODE.split(text)
+    return ''.join(
+        f'<code>{part}</code>' if i % 2 else _emphasis(part)
+        for i, part in enumerate(parts)
+    )
+
+
+def _table_cells(line):
+    return [render_inline(cell.strip()) for cell in line.strip().strip('|').split('|')]
+
+
+class MarkdownRenderer:
+    """Incremental markdown renderer; feed() text as it arrives, then close().
+
+    Complete lines are rendered as soon as their newline arrives. A line that
+    looks like a table header is held back one line until the separator row
+    confirms it, and a blank line inside a list is held until the next line
+    shows whether the list continues.
+    """
+
+    def __init__(self):
+        self._partial = []
+        self._lists = []          # stack of [tag, indent]
+        self._code_fence = None   # fence marker while inside a code block
+        self._code_lines = 0
+        self._in_table = False
+        self._pending_row = None  # possible table header awaiting its separator
+        self._blank_in_list = False
+        self._blank_run = 0
+
+    def feed(self, text):
+        """Consume a chunk of markdown and return the HTML for any completed lines"""
+        if not text:
+            return ''
+        if '\n' not in text:
+            self._partial.append(text)
+            return ''
+        out = []
+        pieces = text.split('\n')
+        self._partial.append(pieces[0])
+        self._line(''.join(self._partial), out)
+        for line in pieces[1:-1]:
+            self._line(line, out)
+        self._partial = [pieces[-1]]
+        return ''.join(out)
+
+    def close(self):
+        """Render the trailing partial line and close every open element"""
+        out = []
+        tail = ''.join(self._partial)
+        self._partial = []
+        if tail:
+            self._line(tail, out)
+        if self._code_fence is not None:
+            out.append('</code></pre>\n')
+            self._code_fence = None
+        self._end_blocks(out)
+        return ''.join(out)
+
+    def _line(self, line, out):
+        if self._code_fence is not None:
+            if line.strip().startswith(self._code_fence):
+                out.append('</code></pre>\n')
+                self._code_fence = None
+            else:
+                out.append(('\n' if self._code_lines else '') + html.escape(line, quote=False))
+                self._code_lines += 1
+            return
+
+        stripped = line.strip()
+
+        if self._pending_row is not None:
+            header, self._pending_row = self._pending_row, None
+            if TABLE_SEPARATOR.match(stripped):
+                cells = ''.join(f'<th>{cell}</th>' for cell in _table_cells(header))
+                out.append(f'<table>\n<thead><tr>{cells}</tr></thead>\n<tbody>\n')
+                self._in_table = True
+                return
+            self._paragraph(header, out)
+
+        if self._in_table:
+            if stripped.startswith('|'):
+                cells = ''.join(f'<td>{cell}</td>' for cell in _table_cells(stripped))
+                out.append(f'<tr>{cells}</tr>\n')
+                return
+            out.append('</tbody>\n</table>\n')
+            self._in_table = False
+
+        if not stripped:
+            if self._lists:
+                self._blank_in_list = True
+                return
+            self._blank_run += 1
+            if self._blank_run <= 2:
+                out.append('<br>\n')
+            return
+        self._blank_run = 0
+
+        fence = FENCE.match(line)
+        if fence:
+            self._end_blocks(out)
+            self._code_fence = fence.group(1)
+            self._code_lines = 0
+            language = fence.group(2)
+            out.append(f'<pre><code class="language-{html.escape(language)}">' if language else '<pre><code>')
+            return
+
+        if HORIZONTAL_RULE.match(stripped):
+            self._end_blocks(out)
+            out.append('<hr>\n')
+            return
+
+        item = LIST_ITEM.match(line)
+        if item:
+            self._list_item(item.group(1), item.group(2), item.group(3), out)
+            return
+
+        if self._lists and not self._blank_in_list and line[:1] in (' ', '\t'):
+            # Indented continuation of the current list item
+            out.append('<br>' + render_inline(stripped))
+            return
+
+        self._end_blocks(out)
+
+        heading = HEADING.match(stripped)
+        if heading:
+            level = len(heading.group(1))
+            out.append(f'<h{level}>{render_inline(heading.group(2))}</h{level}>\n')
+        elif stripped.startswith('|'):
+            self._pending_row = stripped
+        else:
+            self._paragraph(stripped, out)
+
+    def _paragraph(self, text, out):
+        out.append(f'<p>{render_inline(text)}</p>\n')
+
+    def _list_item(self, indent_text, marker, text, out):
+        indent = len(indent_text.expandtabs(4))
+        tag = 'ol' if marker[0].isdigit() else 'ul'
+        self._blank_in_list = False
+
+        while self._lists and self._lists[-1][1] > indent:
+            closed_tag, _ = self._lists.pop()
+            out.append(f'</li></{closed_tag}>\n')
+        if self._lists and self._lists[-1][1] == indent:
+            if self._lists[-1][0] == tag:
+                out.append(f'</li>\n<li>{render_inline(text)}')
+                return
+            closed_tag, _ = self._lists.pop()
+            out.append(f'</li></{closed_tag}>\n')
+
+        start = ''
+        if tag == 'ol':
+            number = int(marker[:-1])
+            if number != 1:
+                start = f' start="{number}"'
+        out.append(f'<{tag}{start}>\n<li>{render_inline(text)}')
+        self._lists.append([tag, indent])
+
+    def _end_blocks(self, out):
+        """Close open lists and tables and resolve a held-back table header"""
+        if self._pending_row is not None:
+            self._paragraph(self._pending_row, out)
+            self._pending_row = None
+        if self._in_table:
+            out.append('</tbody>\n</table>\n')
+            self._in_table = False
+        while self._lists:
+            tag, _ = self._lists.pop()
+            out.append(f'</li></{tag}>\n')
+        self._blank_in_list = False
+
+
+def render_markdown(text):
+    """Render a complete markdown string to HTML"""
+    renderer = MarkdownRenderer()
+    return renderer.feed(text) + renderer.close()
+
+
+def _benchmark():
+    import time
+
+    block = (
+        "## Section heading\n"
+        "Some **bold** text, some *italic* text and `inline code` with <tags> & entities.\n"
+        "\n"
+        "1. First step\n"
+        "2. Second step\n"
+        "   - nested detail\n"
+        "   - another *detail*\n"
+        "3. Third step\n"
+        "\n"
+        "| Column | Value |\n"
+        "|--------|-------|\n"
+        "| a | **1** |\n"
+        "```python\n"
+        "print('hello')\n"
+        "```\n"
+        "Closing paragraph.\n"
+    )
+    block_lines = block.count('\n')
+    print(f"{'lines':>8} {'full (ms)':>10} {'stream (ms)':>12} {'us/line':>8}")
+    for target_lines in (1000, 2000, 4000, 8000, 16000, 32000):
+        text = block * (target_lines // block_lines)
+        lines = text.count('\n')
+
+        started = time.perf_counter()
+        render_markdown(text)
+        full_ms = (time.perf_counter() - started) * 1000
+
+        # Simulate an LLM stream of ~4 character tokens
+        tokens = [text[i:i + 4] for i in range(0, len(text), 4)]
+        started = time.perf_counter()
+        renderer = MarkdownRenderer()
+        for token in tokens:
+            renderer.feed(token)
+        renderer.close()
+        stream_ms = (time.perf_counter() - started) * 1000
+
+        print(f"{lines:>8} {full_ms:>10.1f} {stream_ms:>12.1f} {full_ms * 1000 / lines:>8.2f}")
+
+
+if __name__ == "__main__":
+    _benchmark()